@@ -6,23 +6,28 @@ import os
 import numpy as np
 from datetime import datetime
 from numpy import ravel
-from pickle import load
 from json import dump
 from scipy.spatial.distance import cosine, euclidean
-from gensim.models import TfidfModel
 from collections import Counter
 
+import metrics
+from course_index import CourseIndex
+from courses import COURSE_NAME_STUBS
+from eval_store import EvalStore, eval_path
+
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
 
-def analyze_course_results(course_name, course_results, idf_vec_size):
+@metrics.spanned("analyze")
+def analyze_course_results(course_name, eval_store):
     t_start = datetime.now()
     print("ANALYZING {} ({})".format(course_name, t_start))
-    docid_to_labels = invert_mapping(course_results["mapping"])
+    docid_to_labels = eval_store.course_index().docid_to_labels()
+    idf_vec_size = eval_store.idf_vec_size
 
-    material_results = course_results["material_results"]
-    question_results = course_results["question_results"]
-    answer_results = course_results["answer_results"]
+    material_results = eval_store.results("material")
+    question_results = eval_store.results("questions")
+    metrics.count("docs", len(question_results))
 
     # question_id: { atm: [(doc, distance)], hdp: [(doc, distance)]}
     questions_topic_mapping = {}
@@ -178,6 +183,20 @@ def generate_topic_map(distance_options, material_results, atm, hdp, lda, llda,
     return topic_map
 
 
+def model_reciprocal_ranks(cosine_ranks, correct_labels, question_ids):
+    """{model rank name: [1 / (rank of the correct document + 1)]} over
+    question_ids, given the question topic maps and {question id: doc id}
+    """
+    all_model_rrs = {}
+    for qid in question_ids:
+        correct = correct_labels[qid]
+        for model_name, model_rank in cosine_ranks[qid].items():
+            model_choices = [doc_id for (doc_id, _score) in model_rank]
+            all_model_rrs.setdefault(model_name, []).append(
+                1 / (model_choices.index(correct) + 1))
+    return all_model_rrs
+
+
 def flatten_gammas(result, idf_vec_size):
     atm = ravel(result["atm"])
     hdp = ravel(result["hdp"])
@@ -195,51 +214,14 @@ def invert_mapping(mapping):
     """document to hierarchy labels.
     [modules, lessons, items]
     """
-    inverted_mapping = {}
-    for coursera_item_type, value_dict in mapping.items():
-        # coursera_item_type one of [modules, lessons, items]
-        for item_name, doc_ids in value_dict.items():
-            for doc_id in doc_ids:
-                doc_type = inverted_mapping.get(doc_id, [None, None, None])
-                if coursera_item_type == "items":
-                    doc_type[2] = item_name
-                elif coursera_item_type == "lessons":
-                    doc_type[1] = item_name
-                elif coursera_item_type == "modules":
-                    doc_type[0] = item_name
-                else:
-                    raise NotImplementedError(coursera_item_type)
-                inverted_mapping[doc_id] = doc_type
-    return inverted_mapping
+    return CourseIndex.from_mapping(mapping).docid_to_labels()
 
 
 def main():
-    COURSE_NAME_STUBS = [
-        "agile-planning-for-software-products",
-        "client-needs-and-software-requirements",
-        "design-patterns",
-        "introduction-to-software-product-management",
-        "object-oriented-design",
-        "reviews-and-metrics-for-software-improvements",
-        "service-oriented-architecture",
-        "software-architecture",
-        "software-processes-and-agile-practices",
-        "software-product-management-capstone",
-    ]
     for course_name in COURSE_NAME_STUBS:
-        results_fp = os.path.join(DIR_PATH, "data", "eval.{}.pkl".format(
-            course_name))
-        course_results = None
-        with open(results_fp, "rb") as rf:
-            course_results = load(rf)
-
-        tfidf_fp = os.path.join(
-            DIR_PATH, "data", "tfidf.{}.pkl".format(course_name))
-        # with open(tfidf_fp, "rb") as tfidf_f:
-        tfidf_model = TfidfModel.load(tfidf_fp)
-        idf_vec_size = len(tfidf_model.idfs)
-
-        analyze_course_results(course_name, course_results, idf_vec_size)
+        with metrics.span("course", course=course_name):
+            eval_store = EvalStore(eval_path(course_name))
+            analyze_course_results(course_name, eval_store)
 
 
 if __name__ == "__main__":
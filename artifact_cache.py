@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Content-addressed cache of trained models and evaluation outputs, so that
+reruns with unchanged inputs and hyperparameters skip the work.
+"""
+import os
+import json
+import pickle
+import hashlib
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# bump when a change to the pipeline makes old entries wrong
+CACHE_VERSION = 1
+
+
+def file_digest(path, block=1 << 20):
+    """sha256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    """Pickled entries under root, one file per key. Entries are replaced
+    atomically, so several processes can share the directory; the least
+    recently used are evicted once the directory exceeds max_bytes.
+    """
+
+    def __init__(self, root=None, max_bytes=2 << 30):
+        self.root = root or os.path.join(DIR_PATH, "data", "cache")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+        self.evict()
+
+    def key(self, *parts):
+        """digest of the parts (input digests, model type, hyperparameters)"""
+        blob = json.dumps([CACHE_VERSION, parts], sort_keys=True, default=repr)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key + ".pkl")
+
+    def get(self, key):
+        """the entry stored under key, or None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # mark as recently used for eviction
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict(keep=os.path.basename(path))
+        return value
+
+    def digest(self, key):
+        """digest of the stored entry, identifying what was cached under key"""
+        path = self._path(key)
+        return file_digest(path) if os.path.exists(path) else None
+
+    def evict(self, keep=None):
+        """remove least recently used entries, other than keep, until within
+        max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".pkl") or name == keep:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(os.path.join(self.root, keep)):
+            total += os.path.getsize(os.path.join(self.root, keep))
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            total -= size
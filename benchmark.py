@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Benchmark model training, inference and analysis on a synthetic course, so
+performance can be measured without the Coursera dump. The course hierarchy,
+material and forum posts are generated in the shapes load_and_preprocess.py
+writes (vocabulary/questions/answers JSON), every question drawn from a known
+item. Each run appends one line of per-stage timings, throughput and peak RSS
+to data/benchmark.jsonl and is compared with the last run of the same size.
+"""
+import os
+import json
+import random
+import resource
+import subprocess
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime
+from optparse import OptionParser
+from time import perf_counter
+
+from gensim.corpora.dictionary import Dictionary
+from gensim.models import TfidfModel
+from scipy.spatial.distance import cosine
+from statistics import mean
+
+import build_run_eval_lda_models as build
+from analyze_model_results import flatten_gammas, generate_topic_map, model_reciprocal_ranks
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+RESULTS_FP = os.path.join(DIR_PATH, "data", "benchmark.jsonl")
+# share of a document's words drawn from its module, lesson and item topics,
+# the rest is drawn from the whole vocabulary
+TOPIC_MIX = (0.3, 0.3, 0.3)
+
+
+def _draw_words(rnd, windows, length, vocab_size):
+    words = []
+    for _ in range(length):
+        r = rnd.random()
+        for (start, width), share in zip(windows, TOPIC_MIX):
+            if r < share:
+                words.append("w{:05d}".format((start + rnd.randrange(width)) % vocab_size))
+                break
+            r -= share
+        else:
+            words.append("w{:05d}".format(rnd.randrange(vocab_size)))
+    return words
+
+
+def make_course(modules=4, lessons=4, items=4, doc_length=300, vocab_size=2000,
+                questions=200, answers=200, post_length=40, seed=0):
+    """(vocabulary, questions, answers, question doc ids): a course of
+    modules x lessons x items documents and forum posts, each post drawn from
+    one item. question doc ids maps question id -> the material doc id of its
+    item, the correct answer for the MRR.
+    """
+    rnd = random.Random(seed)
+    width = max(10, vocab_size // 50)
+    vocabulary = {}
+    item_windows = []
+    for m in range(modules):
+        module_name = "module {}".format(m + 1)
+        module_window = (rnd.randrange(vocab_size), width)
+        for l in range(lessons):
+            lesson_name = "lesson {}.{}".format(m + 1, l + 1)
+            lesson_window = (rnd.randrange(vocab_size), width)
+            for i in range(items):
+                item_name = "item {}.{}.{}".format(m + 1, l + 1, i + 1)
+                windows = (module_window, lesson_window, (rnd.randrange(vocab_size), width))
+                item_windows.append(windows)
+                length = rnd.randint(doc_length // 2, doc_length * 3 // 2)
+                vocabulary.setdefault(module_name, {}).setdefault(lesson_name, {})[item_name] = \
+                    _draw_words(rnd, windows, length, vocab_size)
+
+    def make_posts(prefix, count):
+        posts, doc_ids = {}, {}
+        for p in range(count):
+            post_id = "{}{}".format(prefix, p)
+            doc_ids[post_id] = rnd.randrange(len(item_windows))
+            length = rnd.randint(post_length // 2, post_length * 3 // 2)
+            posts[post_id] = _draw_words(rnd, item_windows[doc_ids[post_id]], length, vocab_size)
+        return posts, doc_ids
+
+    course_questions, question_doc_ids = make_posts("q", questions)
+    course_answers, _ = make_posts("a", answers)
+    return vocabulary, course_questions, course_answers, question_doc_ids
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DIR_PATH,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stages(object):
+    """times stages run through it, recording seconds, docs/s, tokens/s and
+    the peak RSS of the process so far
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.records = {}
+
+    def run(self, name, docs, tokens, func, *args, **kwargs):
+        with open(os.devnull, "w") as devnull, (nullcontext() if self.verbose else redirect_stdout(devnull)):
+            start = perf_counter()
+            result = func(*args, **kwargs)
+            seconds = perf_counter() - start
+        self.records[name] = {
+            "seconds": seconds,
+            "docs": docs,
+            "tokens": tokens,
+            "docs_per_s": docs / seconds if seconds else None,
+            "tokens_per_s": tokens / seconds if tokens and seconds else None,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        print("{:<18} {:>9.3f}s {:>11.1f} docs/s {:>12} tokens/s {:>8.1f} MB".format(
+            name, seconds, self.records[name]["docs_per_s"] or 0,
+            "{:.1f}".format(self.records[name]["tokens_per_s"]) if tokens else "-",
+            self.records[name]["peak_rss_mb"]))
+        return result
+
+
+def topic_maps(material_results, question_results, idf_vec_size):
+    maps = {}
+    for question_id, question_result in question_results.items():
+        atm, hdp, lda, llda, tfidf = flatten_gammas(question_result, idf_vec_size)
+        maps[question_id] = generate_topic_map(
+            (cosine, False), material_results, atm, hdp, lda, llda, tfidf, idf_vec_size)
+    return maps
+
+
+def run_benchmark(course_name, params, verbose=False):
+    """generate the course into data/, run every stage on it and return
+    ({stage: record}, {model rank name: MRR})
+    """
+    vocabulary, course_questions, course_answers, question_doc_ids = make_course(**params)
+    fps = []
+    for kind, content in (("vocabulary", vocabulary), ("questions", course_questions),
+                          ("answers", course_answers)):
+        fps.append(os.path.join(DIR_PATH, "data", "{}.{}.json".format(kind, course_name)))
+        with open(fps[-1], "w") as f:
+            json.dump(content, f)
+
+    stages = Stages(verbose)
+    try:
+        course_texts, course_index = build.extract_course_texts_mapping(vocabulary)
+        course_dictionary = Dictionary(course_texts)
+        course_corpus = [course_dictionary.doc2bow(text) for text in course_texts]
+        n_docs = len(course_texts)
+        n_tokens = sum(len(text) for text in course_texts)
+        n_questions = len(course_questions)
+        n_question_tokens = sum(len(words) for words in course_questions.values())
+        print("{} docs, {} tokens, {} terms, {} questions".format(
+            n_docs, n_tokens, len(course_dictionary), n_questions))
+
+        lda_model = stages.run("lda_train", n_docs, n_tokens,
+                               build.train_lda, course_corpus, course_dictionary)
+        hdp_model = stages.run("hdp_train", n_docs, n_tokens,
+                               build.train_hdp, course_corpus, course_dictionary)
+        at_model = stages.run("atm_train", n_docs, n_tokens,
+                              build.train_atm, course_corpus, course_dictionary, course_index)
+        llda_model, _ = stages.run("llda_train", n_docs, n_tokens,
+                                   build.train_llda, course_index, course_texts)
+        stages.run("llda_inference", n_questions, n_question_tokens,
+                   lambda: [llda_model.inference(words) for words in course_questions.values()])
+        stages.run("llda_fold_in", n_questions, n_question_tokens,
+                   llda_model.inference_many, list(course_questions.values()), **build.LLDA_FOLD_IN)
+        tfidf_model = TfidfModel(corpus=course_corpus, id2word=course_dictionary)
+
+        c_start = datetime.now()
+        material_results = stages.run(
+            "eval_material", n_docs, n_tokens, build.eval_material,
+            course_texts, course_corpus, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start)
+        question_results = stages.run(
+            "eval_questions", n_questions, n_question_tokens, build.eval_questions,
+            course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start)
+        cosine_ranks = stages.run("topic_map", n_questions, None, topic_maps,
+                                  material_results, question_results, len(tfidf_model.idfs))
+        all_model_rrs = stages.run("mrr", n_questions, None, model_reciprocal_ranks,
+                                   cosine_ranks, question_doc_ids, list(cosine_ranks))
+    finally:
+        for fp in fps:
+            os.remove(fp)
+    return stages.records, {model_name: mean(rrs) for model_name, rrs in all_model_rrs.items()}
+
+
+def previous_run(results_fp, params):
+    """last recorded run with the same course parameters, or None"""
+    if not os.path.isfile(results_fp):
+        return None
+    last = None
+    with open(results_fp, "r") as rf:
+        for line in rf:
+            run = json.loads(line)
+            if run["params"] == params:
+                last = run
+    return last
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--modules", dest="modules", type="int", default=4)
+    parser.add_option("--lessons", dest="lessons", type="int", default=4,
+                      help="lessons per module")
+    parser.add_option("--items", dest="items", type="int", default=4,
+                      help="items (documents) per lesson")
+    parser.add_option("--doc-length", dest="doc_length", type="int", default=300,
+                      help="mean words per document")
+    parser.add_option("--vocab-size", dest="vocab_size", type="int", default=2000)
+    parser.add_option("--questions", dest="questions", type="int", default=200)
+    parser.add_option("--answers", dest="answers", type="int", default=200)
+    parser.add_option("--post-length", dest="post_length", type="int", default=40,
+                      help="mean words per forum post")
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+    parser.add_option("-o", dest="results_fp", default=RESULTS_FP,
+                      help="results file, one JSON line per run")
+    parser.add_option("-v", dest="verbose", action="store_true", default=False,
+                      help="show the output of the benchmarked stages")
+    (options, args) = parser.parse_args()
+    params = {name: getattr(options, name) for name in (
+        "modules", "lessons", "items", "doc_length", "vocab_size",
+        "questions", "answers", "post_length", "seed")}
+
+    os.makedirs(os.path.dirname(os.path.abspath(options.results_fp)), exist_ok=True)
+    previous = previous_run(options.results_fp, params)
+    records, mrr = run_benchmark("synthetic-benchmark", params, options.verbose)
+    run = {
+        "run": datetime.now().isoformat(),
+        "revision": git_revision(),
+        "params": params,
+        "cpus": os.cpu_count(),
+        "stages": records,
+        "mrr": mrr,
+    }
+    with open(options.results_fp, "a") as rf:
+        rf.write(json.dumps(run) + "\n")
+
+    for model_name, model_mrr in sorted(mrr.items()):
+        print("{} mrr: {:.3f}".format(model_name, model_mrr))
+    if previous is not None:
+        print("vs {} ({}):".format(previous["run"], previous["revision"]))
+        for name, record in records.items():
+            before = previous["stages"].get(name)
+            if before:
+                print("{:<18} {:>9.3f}s -> {:.3f}s ({:.2f}x)".format(
+                    name, before["seconds"], record["seconds"], before["seconds"] / record["seconds"]))
+
+
+if __name__ == "__main__":
+    main()
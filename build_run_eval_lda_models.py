@@ -4,227 +4,500 @@ Create the baseline TF-IDF model, along with the LDA topic models.
 Infer topic document distributions for all course material and forum content.
 """
 import os
+import sys
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stdout
 from datetime import datetime
+from itertools import islice
+from multiprocessing import get_context
+from optparse import OptionParser
+from gensim import __version__ as gensim_version
 from gensim.test.utils import common_texts
+from gensim.corpora import MmCorpus
 from gensim.corpora.dictionary import Dictionary
-from gensim.models import HdpModel, LdaModel, AuthorTopicModel, TfidfModel
-from numpy import argsort
-from pickle import dump
-
+from gensim.models import HdpModel, LdaModel, LdaMulticore, AuthorTopicModel, TfidfModel
+from numpy import argsort, median
+
+import metrics
+from artifact_cache import ArtifactCache, file_digest
+from course_index import CourseIndex
+from courses import COURSE_NAME_STUBS
+from eval_store import EvalWriter, eval_path, save_eval
+from inference_memo import InferenceMemo
 from llda_impl import LLDA
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# per-worker thread limits of the numerical libraries in --jobs mode
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+MODEL_NAMES = ("lda", "hdp", "atm", "llda")
+LLDA_PARAMS = {"alpha": 0.01, "beta": 0.001, "iterations": 50}
+# documents per gensim inference call during evaluation
+EVAL_CHUNKSIZE = 256
+# forum posts held in memory at a time when streaming the evaluation
+EVAL_BATCH = 2048
+# MB of topic vectors memoized for repeated forum posts (0 disables, the
+# default, as reuse changes later vectors: see InferenceMemo)
+EVAL_MEMO_MB = 0
+# adaptive llda fold-in: warm start, stop once theta settles (max 50 sweeps)
+LLDA_FOLD_IN = {"iteration": 50, "min_iteration": 3, "tol": 0.05, "warm_start": True}
+
+
+@contextmanager
+def thread_limits(cores):
+    """cap the numerical library threads of processes started in this block"""
+    saved_env = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(cores) for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+@contextmanager
+def job_pool(jobs):
+    """(executor, cores): a pool of jobs spawned processes, the numerical
+    library threads of each capped to its share of the cores. Spans of the
+    workers are recorded if metrics are configured before the pool starts.
+    """
+    cores = max(1, (os.cpu_count() or 1) // jobs)
+    # spawned workers read the thread limits when they import numpy
+    with thread_limits(cores), ProcessPoolExecutor(jobs, mp_context=get_context("spawn")) as executor:
+        yield executor, cores
 
 
 def extract_course_texts_mapping(course_vocabulary):
-    mapping = {}
+    course_index = CourseIndex()
     course_texts = []
     for module_name, lessons_vocabulary in course_vocabulary.items():
         for lesson_name, items_vocabulary in lessons_vocabulary.items():
             for item_name, document_words in items_vocabulary.items():
                 if document_words:
-                    module_mapping = mapping.get("modules", {})
-                    module_map_vals = module_mapping.get(module_name, [])
-                    module_map_vals.append(len(course_texts))
-                    module_mapping[module_name] = module_map_vals
-                    mapping["modules"] = module_mapping
-
-                    lesson_mapping = mapping.get("lessons", {})
-                    lesson_map_vals = lesson_mapping.get(lesson_name, [])
-                    lesson_map_vals.append(len(course_texts))
-                    lesson_mapping[lesson_name] = lesson_map_vals
-                    mapping["lessons"] = lesson_mapping
-
-                    item_mapping = mapping.get("items", {})
-                    item_map_vals = item_mapping.get(item_name, [])
-                    item_map_vals.append(len(course_texts))
-                    item_mapping[item_name] = item_map_vals
-                    mapping["items"] = item_mapping
-
+                    course_index.add_document(module_name, lesson_name, item_name)
                     course_texts.append(document_words)
-    return course_texts, mapping
+    return course_texts, course_index.freeze()
+
+
+def course_corpus_fp(course_name):
+    return os.path.join(DIR_PATH, "data", "corpus.{}.mm".format(course_name))
+
+
+def serialize_corpus(corpus_fp, course_texts, course_dictionary):
+    """write the bag of words of every text to the Matrix Market file
+    corpus_fp (and its offset index) one document at a time, returning the
+    MmCorpus streaming it back from disk
+    """
+    MmCorpus.serialize(corpus_fp, (course_dictionary.doc2bow(text) for text in course_texts),
+                       id2word=course_dictionary)
+    return MmCorpus(corpus_fp)
 
 
-def build_lda_models(course_corpus, course_dictionary, mapping, course_texts):
+def train_lda(course_corpus, course_dictionary, cores=1, multicore=False, params=None):
     # ==== Train Unsupervised LDA ====
-    lda_model = LdaModel(
+    # params: LdaModel settings other than the corpus (gensim defaults if None)
+    if multicore and cores > 1:
+        # one core for the master, the rest for the E-step workers
+        return LdaMulticore(
+            corpus=course_corpus,
+            id2word=course_dictionary,
+            workers=cores - 1,
+            **(params or {})
+        )
+    return LdaModel(
         corpus=course_corpus,
-        id2word=course_dictionary
+        id2word=course_dictionary,
+        **(params or {})
     )
 
+
+def train_hdp(course_corpus, course_dictionary, params=None):
     # ==== Train Unsupervised HDP-LDA ====
-    hdp_model = HdpModel(
+    return HdpModel(
         corpus=course_corpus,
-        id2word=course_dictionary
+        id2word=course_dictionary,
+        **(params or {})
     )
 
+
+def train_atm(course_corpus, course_dictionary, course_index, params=None):
     # ==== Train Author Topic Model ====
     author_to_doc = {}  # author topic LDA (authors are modules,lessons,items)
-    for author_type in ["modules", "lessons", "items"]:
-        entity_to_doc = mapping[author_type]
-        for entity_name, entity_docs in entity_to_doc.items():
+    for author_type in course_index.LEVELS:
+        for entity_name in course_index.names[author_type]:
             author_to_doc["{}: {}".format(
-                author_type[0].capitalize(), entity_name)] = entity_docs
-    at_model = AuthorTopicModel(
+                author_type[0].capitalize(), entity_name)] = course_index.docs(author_type, entity_name).tolist()
+    if isinstance(course_corpus, MmCorpus):
+        # gensim only takes a streamed corpus as a serialized copy of its own,
+        # which it will not overwrite; inference never reads an earlier one
+        atm_fp = course_corpus.input + ".atm"
+        for fp in (atm_fp, atm_fp + ".index"):
+            if os.path.isfile(fp):
+                os.remove(fp)
+        params = dict({"serialized": True, "serialization_path": atm_fp}, **(params or {}))
+    return AuthorTopicModel(
         corpus=course_corpus,
         id2word=course_dictionary,
-        author2doc=author_to_doc
+        author2doc=author_to_doc,
+        **(params or {})
     )
 
+
+def train_llda(course_index, course_texts, cores=1, params=None):
     # ==== Train Labeled LDA ====
-    # explicitly supervised, labeled LDA
-    llda_alpha = 0.01
-    llda_beta = 0.001
-    llda_iterations = 50
+    # explicitly supervised, labeled LDA; params override LLDA_PARAMS (and may add a seed)
+    llda_params = dict(LLDA_PARAMS, **(params or {}))
+    llda_alpha = llda_params["alpha"]
+    llda_beta = llda_params["beta"]
+    llda_iterations = llda_params["iterations"]
     llda_labels = []
     llda_corpus = []
     labelset = set()
     for course_text_id in range(0, len(course_texts)):
-        doc_labels = []
-        # get module label name
-        for module_name, doc_vec in mapping["modules"].items():
-            if course_text_id in doc_vec:
-                doc_labels.append("M: {}".format(module_name))
-                break
-
-        # get lesson label name
-        for lesson_name, doc_vec in mapping["lessons"].items():
-            if course_text_id in doc_vec:
-                doc_labels.append("L: {}".format(lesson_name))
-                break
-
-        for item_name, doc_vec in mapping["items"].items():
-            if course_text_id in doc_vec:
-                doc_labels.append("I: {}".format(item_name))
-                break
+        module_name, lesson_name, item_name = course_index.labels(course_text_id)
+        doc_labels = [
+            "M: {}".format(module_name),
+            "L: {}".format(lesson_name),
+            "I: {}".format(item_name),
+        ]
 
         llda_labels.append(doc_labels)
         llda_corpus.append(course_texts[course_text_id])
         labelset = labelset.union(doc_labels)
 
-    llda_model = LLDA(llda_alpha, llda_beta, K=len(llda_labels))
+    llda_model = LLDA(llda_alpha, llda_beta, K=len(llda_labels), seed=llda_params.get("seed"))
     llda_model.set_corpus(llda_corpus, llda_labels)
-    llda_model.train(iteration=llda_iterations)
+    llda_model.train(iteration=llda_iterations, sparse=True, perplexity_every=10, workers=cores)
 
     # phi = llda.phi()
     # for k, label in enumerate(labelset):
     #     print ("\n-- label %d : %s" % (k + 1, label))
     #     for w in argsort(-phi[k + 1])[:10]:
     #         print("%s: %.4f" % (llda.vocas[w], phi[k + 1,w]))
-    return lda_model, hdp_model, at_model, llda_model, llda_labels
+    return llda_model, llda_labels
+
+
+def split_cores(cores):
+    """core budget of each model training, at least one core each; LDA gets
+    the remainder since it is the one with a multicore backend
+    """
+    share = max(1, cores // len(MODEL_NAMES))
+    core_budget = {name: share for name in MODEL_NAMES}
+    core_budget["lda"] = max(1, cores - share * (len(MODEL_NAMES) - 1))
+    return core_budget
+
+
+def model_keys(cache, input_digest, core_budget, lda_multicore=False):
+    """cache key of each model: its input, type and the settings it is
+    trained with
+    """
+    model_params = {
+        "lda": {"multicore": lda_multicore and core_budget["lda"] > 1,
+                "workers": core_budget["lda"] if lda_multicore else 1},
+        "hdp": {},
+        "atm": {},
+        "llda": dict(LLDA_PARAMS, workers=core_budget["llda"]),
+    }
+    return {name: cache.key("model", name, input_digest, model_params[name], gensim_version)
+            for name in MODEL_NAMES}
+
+
+def _train_model(name, train, args, parent=None, log_fp=None):
+    # parent: metrics.context() of the spawning process, so the span keeps its
+    # course; log_fp: its process_course log, as a spawned process writes to
+    # the inherited fd 1 and 2, not to the redirected sys.stdout
+    if log_fp is not None:
+        with open(log_fp, "a") as lf:
+            os.dup2(lf.fileno(), 1)
+            os.dup2(lf.fileno(), 2)
+    try:
+        with metrics.remote_parent(parent), metrics.span("train", model=name):
+            return train(*args)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def build_lda_models(course_corpus, course_dictionary, course_index, course_texts,
+                     core_budget=None, lda_multicore=False, concurrent=None,
+                     cache=None, input_digest=None, log_fp=None):
+    """train the LDA, HDP, author topic and labeled LDA models. core_budget
+    maps each of MODEL_NAMES to its cores (default: split_cores of all of
+    them). With concurrent (default: more than one core), each model trains
+    in its own process, its numerical library threads capped to its budget;
+    LDA (with lda_multicore) and LLDA also use the budget as worker counts.
+    With an ArtifactCache, models already trained on the input with the
+    digest input_digest are loaded instead. log_fp is the file the output of
+    the concurrent processes goes to (default: the terminal).
+    """
+    if core_budget is None:
+        core_budget = split_cores(os.cpu_count() or 1)
+    if concurrent is None:
+        concurrent = (os.cpu_count() or 1) > 1
+    cached = {}
+    if cache is not None:
+        keys = model_keys(cache, input_digest, core_budget, lda_multicore)
+        for name in MODEL_NAMES:
+            model = cache.get(keys[name])
+            if model is not None:
+                cached[name] = model
+        if cached:
+            print("cached models: {}".format(", ".join(cached)))
+    trainers = {
+        "lda": (train_lda, (course_corpus, course_dictionary, core_budget["lda"], lda_multicore)),
+        "hdp": (train_hdp, (course_corpus, course_dictionary)),
+        "atm": (train_atm, (course_corpus, course_dictionary, course_index)),
+        "llda": (train_llda, (course_index, course_texts, core_budget["llda"])),
+    }
+    trainers = {name: trainer for name, trainer in trainers.items() if name not in cached}
+    if not concurrent or len(trainers) <= 1:
+        models = {name: _train_model(name, train, args) for name, (train, args) in trainers.items()}
+    else:
+        executors = []
+        futures = {}
+        # ahead of the output of the processes, which append to log_fp
+        sys.stdout.flush()
+        try:
+            for name, (train, args) in trainers.items():
+                # the process starts on submit, inheriting this thread limit
+                with thread_limits(core_budget[name]):
+                    executor = ProcessPoolExecutor(1, mp_context=get_context("spawn"))
+                    executors.append(executor)
+                    futures[name] = executor.submit(_train_model, name, train, args, metrics.context(), log_fp)
+            models = {name: future.result() for name, future in futures.items()}
+        finally:
+            for executor in executors:
+                executor.shutdown()
+    if cache is not None:
+        for name, model in models.items():
+            cache.put(keys[name], model)
+    models.update(cached)
+    llda_model, llda_labels = models["llda"]
+    return models["lda"], models["hdp"], models["atm"], llda_model, llda_labels
+
+
+def infer_lda_gammas(chunks, lda_model):
+    lda_gammas = []
+    with metrics.span("infer", model="lda"):
+        for chunk in chunks:
+            lda_gamma = lda_model.inference(chunk=chunk)[0]
+            lda_gammas.extend(lda_gamma[d:d + 1] for d in range(len(chunk)))
+    return lda_gammas
+
+
+def infer_hdp_gammas(chunks, hdp_model):
+    hdp_gammas = []
+    with metrics.span("infer", model="hdp"):
+        for chunk in chunks:
+            hdp_gammas.extend(hdp_model.inference(chunk=chunk))
+    return hdp_gammas
+
+
+def infer_atm_gammas(chunks, at_model, author2doc, doc2author, rhot=0.1):
+    # gensim's author topic inference reads the authors of the model's own
+    # doc2author[chunk_doc_idx[d]], which the one-document calls left at 0
+    n_authors = len(at_model.doc2author[0])
+    at_gammas = []
+    with metrics.span("infer", model="atm"):
+        for chunk in chunks:
+            at_gamma = at_model.inference(
+                chunk=chunk,
+                author2doc=author2doc,
+                doc2author=doc2author,
+                rhot=rhot,
+                chunk_doc_idx=[0] * len(chunk)
+            )[0]
+            at_gammas.extend(at_gamma[d * n_authors:(d + 1) * n_authors] for d in range(len(chunk)))
+    return at_gammas
+
+
+def chunked(corpus, chunksize=EVAL_CHUNKSIZE):
+    """lists of chunksize documents of corpus, read as they are needed"""
+    documents = iter(corpus)
+    chunk = list(islice(documents, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(documents, chunksize))
+
+
+def infer_gammas(corpus, lda_model, hdp_model, at_model, author2doc, doc2author, rhot=0.1, chunksize=EVAL_CHUNKSIZE):
+    """lda, hdp and author topic gammas of every bow in corpus, inferring
+    chunksize documents per model call. Each model handles the documents in
+    order, so the gammas (and the author topic state updated along the way)
+    match one-document calls. corpus is read once per model, so it may be
+    streamed from disk.
+    """
+    return (infer_lda_gammas(chunked(corpus, chunksize), lda_model),
+            infer_hdp_gammas(chunked(corpus, chunksize), hdp_model),
+            infer_atm_gammas(chunked(corpus, chunksize), at_model, author2doc, doc2author, rhot))
+
+
+def eval_posts(course_posts, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+               rhot=0.1, workers=1, chunksize=EVAL_CHUNKSIZE, with_tfidf=True, progress="eval", offset=0, total=None,
+               memo=None):
+    """results of the forum posts {post id: words}. offset and total (None if
+    unknown) only place the posts in the progress output. With an
+    InferenceMemo, posts with the bag of words of an earlier post reuse its
+    topic vectors instead of being inferred again.
+    """
+    post_results = {}
+    metrics.count("docs", len(course_posts))
+    metrics.count("tokens", sum(len(words) for words in course_posts.values()))
+    infer_posts = course_posts
+    if memo is not None:
+        post_keys = {post_id: memo.key(post_words, course_dictionary.token2id)
+                     for post_id, post_words in course_posts.items()}
+        hits = memo.hits
+        memo_vectors, missing = memo.lookup(post_keys.values())
+        metrics.count("memo_hits", memo.hits - hits)
+        metrics.count("memo_misses", len(missing))
+        # infer the first post of each missing bag of words
+        key_posts = {}
+        for post_id, key in post_keys.items():
+            key_posts.setdefault(key, post_id)
+        infer_posts = {key_posts[key]: course_posts[key_posts[key]] for key in missing}
+    # raw text OK here, fold in every post at once
+    llda_gammas = []
+    if infer_posts:
+        with metrics.span("infer", model="llda"):
+            llda_gammas, llda_sweeps = llda_model.inference_many(
+                list(infer_posts.values()), workers=workers, return_iterations=True, **LLDA_FOLD_IN)
+            metrics.count("sweeps", llda_sweeps.sum())
+        print("llda fold-in: median {} sweeps".format(median(llda_sweeps)))
+    # convert to gensim format for gensim models
+    post_corpora = [course_dictionary.doc2bow(post_words)
+                    for post_words in infer_posts.values()]
+    # discussion post relation over set 100 topics (lda), capped 150
+    # topics (hdp) and author to doc relation (each post is a new author)
+    lda_gammas, hdp_gammas, at_gammas = infer_gammas(
+        post_corpora, lda_model, hdp_model, at_model,
+        author2doc={post_id: (idx, ) for idx, post_id in enumerate(infer_posts)},
+        doc2author={idx: (post_id, ) for idx, post_id in enumerate(infer_posts)},
+        rhot=rhot, chunksize=chunksize)
+    inferred = {}
+    for post_idx, post_id in enumerate(infer_posts):
+        inferred[post_id] = {
+            "lda": lda_gammas[post_idx],
+            "hdp": hdp_gammas[post_idx],
+            "atm": at_gammas[post_idx],
+            "llda": llda_gammas[post_idx],
+        }
+    if memo is not None:
+        for key in missing:
+            memo_vectors[key] = inferred[key_posts[key]]
+            memo.put(key, memo_vectors[key])
+    for post_id, post_words in course_posts.items():
+        post_results[post_id] = dict(inferred[post_id] if memo is None else memo_vectors[post_keys[post_id]])
+        if with_tfidf:
+            post_results[post_id]["tfidf"] = tfidf_model[course_dictionary.doc2bow(post_words)]
+        post_results[post_id]["all_words"] = post_words
+        post_results[post_id]["unutilized_words"] = [
+            w for w in post_words if w not in course_dictionary.token2id]
+        print("\r{} {}: {}{} (e: {})".format(
+            progress, post_id, offset + len(post_results),
+            "" if total is None else "/{}".format(total),
+            datetime.now() - c_start), end="")
+    print()
+    return post_results
 
 
-def eval_answers(course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start, rhot=0.1):
-    answer_results = {}
+@metrics.spanned("eval", set="answers")
+def eval_answers(course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start, rhot=0.1, workers=1, chunksize=EVAL_CHUNKSIZE, memo=None):
     answer_fp = os.path.join(
         DIR_PATH, "data", "answers.{}.json".format(course_name))
     with open(answer_fp, "r") as af:
         course_answers = json.load(af)
-    for answer_id, answer_content in course_answers.items():
-        answer_corpus = course_dictionary.doc2bow(answer_content)
-        chunk = (answer_corpus, )
-        # discussion answer relation over set 100 topics
-        lda_a_gamma = lda_model.inference(chunk=chunk)[0]
-        # discussion answer relation over capped 150 topics
-        hdp_a_gamma = hdp_model.inference(chunk=chunk)[0]
-
-        # author to doc relation over 100 topics (each post is a new author)
-        at_a_gamma = at_model.inference(
-            chunk=chunk,
-            author2doc={answer_id: (0, )},
-            doc2author={0: (answer_id,)},
-            rhot=rhot
-        )[0]
-        # raw text OK here
-        llda_a_gamma = llda_model.inference(answer_content)
-
-        tfidf_vector = tfidf_model[answer_corpus]
-
-        answer_results[answer_id] = {
-            "lda": lda_a_gamma,
-            "hdp": hdp_a_gamma,
-            "atm": at_a_gamma,
-            "llda": llda_a_gamma,
-            "all_words": answer_content,
-            "unutilized_words": [w for w in answer_content if w not in course_dictionary.token2id]
-        }
-        print("\ra_eval {}: {}/{} (e: {})".format(
-            answer_id,
-            len(answer_results.keys()), len(course_answers),
-            datetime.now() - c_start), end="")
-    print()
-    return answer_results
+    return eval_posts(
+        course_answers, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+        rhot, workers, chunksize, with_tfidf=False, progress="a_eval", total=len(course_answers), memo=memo)
 
 
-def eval_questions(course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start, rhot=0.1):
-    question_results = {}
+@metrics.spanned("eval", set="questions")
+def eval_questions(course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start, rhot=0.1, workers=1, chunksize=EVAL_CHUNKSIZE, memo=None):
     question_fp = os.path.join(
         DIR_PATH, "data", "questions.{}.json".format(course_name))
     with open(question_fp, "r") as qf:
         # question_id > content
         course_questions = json.load(qf)
-    for question_id, question_words in course_questions.items():
-        # convert to gensim format for gensim models
-        question_corpus = course_dictionary.doc2bow(question_words)
-        chunk = (question_corpus, )
-        # discussion question relation over set 100 topics
-        lda_q_gamma = lda_model.inference(chunk=chunk)[0]
-        # discussion question relation over capped 150 topics
-        hdp_q_gamma = hdp_model.inference(chunk=chunk)[0]
-
-        # author to doc relation over 100 topics (each post is a new author)
-        at_q_gamma = at_model.inference(
-            chunk=chunk,
-            author2doc={question_id: (0, )},
-            doc2author={0: (question_id,)},
-            rhot=rhot
-        )[0]
-        # raw text OK here
-        llda_q_gamma = llda_model.inference(question_words)
-
-        tfidf_vector = tfidf_model[question_corpus]
-
-        question_results[question_id] = {
-            "lda": lda_q_gamma,
-            "hdp": hdp_q_gamma,
-            "atm": at_q_gamma,
-            "llda": llda_q_gamma,
-            "tfidf": tfidf_vector,
-            "all_words": question_words,
-            "unutilized_words": [w for w in question_words if w not in course_dictionary.token2id]
-        }
-        print("\rq_eval {}: {}/{} (e: {})".format(
-            question_id,
-            len(question_results.keys()), len(course_questions),
-            datetime.now() - c_start), end="")
-    print()
-    return question_results
+    return eval_posts(
+        course_questions, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+        rhot, workers, chunksize, progress="q_eval", total=len(course_questions), memo=memo)
+
+
+def posts_fp(course_name, kind):
+    """<kind>.<course>.jsonl (a {"id", "words"} post per line) if preprocessing
+    wrote one, otherwise <kind>.<course>.json
+    """
+    jsonl_fp = os.path.join(DIR_PATH, "data", "{}.{}.jsonl".format(kind, course_name))
+    if os.path.isfile(jsonl_fp):
+        return jsonl_fp
+    return os.path.join(DIR_PATH, "data", "{}.{}.json".format(kind, course_name))
+
+
+def iter_posts(course_name, kind):
+    """(post id, words) of the course's questions or answers, read a line at a
+    time from the .jsonl file, if there is one
+    """
+    fp = posts_fp(course_name, kind)
+    with open(fp, "r") as pf:
+        if not fp.endswith(".jsonl"):
+            yield from json.load(pf).items()
+            return
+        for line in pf:
+            post = json.loads(line)
+            yield post["id"], post["words"]
+
+
+def eval_posts_stream(kind, course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model,
+                      c_start, writer, batch_size=EVAL_BATCH, rhot=0.1, workers=1, chunksize=EVAL_CHUNKSIZE,
+                      memo=None):
+    """evaluate the "questions" or "answers" of a course batch_size posts at a
+    time, appending each batch to the EvalWriter writer. Posts the writer
+    already has from an interrupted run are skipped.
+    """
+    if writer.finished(kind):
+        return
+    done = writer.count(kind)
+    posts = islice(iter_posts(course_name, kind), done, None)
+    with metrics.span("eval", set=kind, stream=True):
+        while True:
+            batch = dict(islice(posts, batch_size))
+            if not batch:
+                break
+            writer.append(kind, eval_posts(
+                batch, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+                rhot, workers, chunksize, with_tfidf=kind == "questions",
+                progress="{}_eval".format(kind[0]), offset=done, memo=memo))
+            done += len(batch)
+        writer.finish_set(kind)
 
 
-def eval_material(course_texts, course_corpus, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start, rhot=0.1):
+@metrics.spanned("eval", set="material")
+def eval_material(course_texts, course_corpus, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start, rhot=0.1, workers=1, chunksize=EVAL_CHUNKSIZE):
     material_results = {}
-    for course_doc_idx in range(0, len(course_texts)):
-        idx_course_corpus = course_corpus[course_doc_idx]
-        chunk = (idx_course_corpus, )
-        lda_c_gamma = lda_model.inference(chunk=chunk)[0]
-        hdp_c_gamma = hdp_model.inference(chunk=chunk)[0]
-        at_c_gamma = at_model.inference(
-            chunk=chunk,
-            author2doc=at_model.author2doc,
-            doc2author=at_model.doc2author,
-            rhot=rhot
-        )[0]
-        idx_course_texts = course_texts[course_doc_idx]
-        llda_c_gamma = llda_model.inference(idx_course_texts)
-
+    metrics.count("docs", len(course_texts))
+    metrics.count("tokens", sum(len(words) for words in course_texts))
+    with metrics.span("infer", model="llda"):
+        llda_c_gammas, llda_sweeps = llda_model.inference_many(
+            course_texts, workers=workers, return_iterations=True, **LLDA_FOLD_IN)
+        metrics.count("sweeps", llda_sweeps.sum())
+    print("llda fold-in: median {} sweeps".format(median(llda_sweeps)))
+    lda_c_gammas, hdp_c_gammas, at_c_gammas = infer_gammas(
+        course_corpus, lda_model, hdp_model, at_model,
+        author2doc=at_model.author2doc,
+        doc2author=at_model.doc2author,
+        rhot=rhot, chunksize=chunksize)
+    for course_doc_idx, idx_course_corpus in enumerate(course_corpus):
         tfidf_vector = tfidf_model[idx_course_corpus]
 
         material_results[course_doc_idx] = {
-            "lda": lda_c_gamma,
-            "hdp": hdp_c_gamma,
-            "atm": at_c_gamma,
-            "llda": llda_c_gamma,
+            "lda": lda_c_gammas[course_doc_idx],
+            "hdp": hdp_c_gammas[course_doc_idx],
+            "atm": at_c_gammas[course_doc_idx],
+            "llda": llda_c_gammas[course_doc_idx],
             "tfidf": tfidf_vector,
         }
         print("\rc_eval {}/{} (e: {})".format(
@@ -234,83 +507,202 @@ def eval_material(course_texts, course_corpus, lda_model, hdp_model, at_model, l
     return material_results
 
 
-def main():
-    COURSE_NAME_STUBS = [
-        "agile-planning-for-software-products",
-        "client-needs-and-software-requirements",
-        "design-patterns",
-        "introduction-to-software-product-management",
-        "object-oriented-design",
-        # "reviews-and-metrics-for-software-improvements",
-        # "service-oriented-architecture",
-        # "software-architecture",
-        # "software-processes-and-agile-practices",
-        # "software-product-management-capstone",
-    ]
-
-    all_corpus = []
-    all_docs = 0
-    all_tokens = 0
-    # for course_name, course_vocabulary in vocabs.items():
-    for course_name in COURSE_NAME_STUBS:
-        # ==== Load the processed vocabulary into memory ==== #
-        vocab_fp = os.path.join(
-            DIR_PATH, "data", "vocabulary.{}.json".format(course_name))
-        with open(vocab_fp, "r") as vf:
-            # course name / module name / lesson name / item name > item
-            course_vocabulary = json.load(vf)
-
-        # ==== Generate Course Corpus, Dictionary ==== #
-        course_texts, mapping = extract_course_texts_mapping(course_vocabulary)
-        course_dictionary = Dictionary(course_texts)
-        course_corpus = [course_dictionary.doc2bow(
-            text) for text in course_texts]
-
-        c_start = datetime.now()
-        print(course_name, len(course_dictionary), len(course_corpus))
-        all_tokens += len(course_dictionary)
-        all_docs += len(course_corpus)
-        all_corpus.extend([len(x) for x in course_corpus])
-        # continue
-
-        print("BUILDING MODELS FOR {} ({})".format(course_name, c_start))
+def process_course(course_name, workers=1, log_fp=None, lda_multicore=False, cache=None, stream_batch=None,
+                   memo_mb=EVAL_MEMO_MB):
+    """build, evaluate and save the models of one course, returning its
+    (dictionary size, document lengths). With log_fp set, the progress output
+    goes to that file instead of stdout. With an ArtifactCache, models and
+    evaluation results of unchanged inputs and settings are reused.
+    With stream_batch set, forum posts are evaluated that many at a time and
+    written to the eval store as they go; with a cache (so the models are the
+    same on a rerun) an interrupted evaluation resumes where it stopped.
+    Forum posts repeating the bag of words of an earlier post reuse its topic
+    vectors, memo_mb MB of them kept at a time (0 infers every post).
+    """
+    if log_fp is None:
+        with metrics.span("course", course=course_name):
+            return _process_course(course_name, workers, lda_multicore, cache, stream_batch, memo_mb)
+    # append mode: the models training in spawned processes write to it too
+    open(log_fp, "w").close()
+    with open(log_fp, "a") as lf, redirect_stdout(lf), metrics.span("course", course=course_name):
+        return _process_course(course_name, workers, lda_multicore, cache, stream_batch, memo_mb, log_fp)
+
+
+def _process_course(course_name, workers, lda_multicore, cache, stream_batch, memo_mb, log_fp=None):
+    # ==== Load the processed vocabulary into memory ==== #
+    vocab_fp = os.path.join(
+        DIR_PATH, "data", "vocabulary.{}.json".format(course_name))
+    with open(vocab_fp, "r") as vf:
+        # course name / module name / lesson name / item name > item
+        course_vocabulary = json.load(vf)
+
+    # ==== Generate Course Corpus, Dictionary ==== #
+    course_texts, course_index = extract_course_texts_mapping(course_vocabulary)
+    course_dictionary = Dictionary(course_texts)
+    # the models stream the bag of words from disk instead of holding a copy
+    course_corpus = serialize_corpus(course_corpus_fp(course_name), course_texts, course_dictionary)
+
+    c_start = datetime.now()
+    print(course_name, len(course_dictionary), len(course_corpus))
+
+    print("BUILDING MODELS FOR {} ({})".format(course_name, c_start))
+    core_budget = split_cores(workers)
+    vocab_digest = file_digest(vocab_fp) if cache is not None else None
+    with metrics.span("build_models"):
+        # once for all four models, which train on the same documents
+        metrics.count("docs", len(course_texts))
+        metrics.count("tokens", sum(len(text) for text in course_texts))
         lda_model, hdp_model, at_model, llda_model, llda_labels = build_lda_models(
             course_corpus, course_dictionary,
-            mapping, course_texts)
+            course_index, course_texts, core_budget, lda_multicore, workers > 1,
+            cache, vocab_digest, log_fp)
 
-        # baseline TF-IDF
-        tfidf_model = TfidfModel(
-            corpus=course_corpus,
-            id2word=course_dictionary,
-        )
+    # baseline TF-IDF
+    tfidf_model = TfidfModel(
+        corpus=course_corpus,
+        id2word=course_dictionary,
+    )
 
-        print("EVALUATING FORUM ACTIVITY {} (e: {})".format(
-            course_name, datetime.now() - c_start))
+    print("EVALUATING FORUM ACTIVITY {} (e: {})".format(
+        course_name, datetime.now() - c_start))
+    eval_results = eval_key = None
+    # repeated posts reuse vectors, so what is reused (the memo size) is part of the results
+    memo = InferenceMemo(memo_mb << 20) if memo_mb else None
+    if cache is not None:
+        # keyed on the stored models, so a retrained model invalidates it
+        keys = model_keys(cache, vocab_digest, core_budget, lda_multicore)
+        eval_key = cache.key(
+            "eval", vocab_digest,
+            [file_digest(os.path.join(DIR_PATH, "data", "{}.{}.json".format(kind, course_name)))
+             for kind in ("questions", "answers")],
+            [cache.digest(keys[name]) for name in MODEL_NAMES],
+            LLDA_FOLD_IN, memo_mb, gensim_version)
+        if stream_batch is None:
+            eval_results = cache.get(eval_key)
+            if eval_results is not None:
+                print("cached evaluation")
+    if stream_batch is not None:
+        resume_key = None if cache is None else cache.key(
+            "stream", eval_key, [file_digest(posts_fp(course_name, kind)) for kind in ("questions", "answers")])
+        writer = EvalWriter(eval_path(course_name), key=resume_key)
+        if writer.count("questions") or writer.count("answers"):
+            print("resuming after {} questions, {} answers".format(
+                writer.count("questions"), writer.count("answers")))
+        if not writer.finished("material"):
+            writer.append("material", eval_material(
+                course_texts, course_corpus, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+                workers=workers))
+            writer.finish_set("material")
+        for kind in ("questions", "answers"):
+            eval_posts_stream(
+                kind, course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model,
+                c_start, writer, stream_batch, workers=workers, memo=memo)
+    elif eval_results is None:
         material_results = eval_material(
-            course_texts, course_corpus, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start)
+            course_texts, course_corpus, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+            workers=workers)
         question_results = eval_questions(
-            course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start)
+            course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+            workers=workers, memo=memo)
         answer_results = eval_answers(
-            course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start)
-
-        print("SAVING VECTORS FOR {} (e: {})".format(
-            course_name, datetime.now() - c_start))
-        results_fp = os.path.join(
-            DIR_PATH, "data", "eval.{}.pkl".format(course_name))
-        with open(results_fp, "wb") as rf:
-            dump({
-                "mapping": mapping,
-                "material_results": material_results,
-                "question_results": question_results,
-                "answer_results": answer_results},
-                rf)
+            course_name, course_dictionary, lda_model, hdp_model, at_model, llda_model, tfidf_model, c_start,
+            workers=workers, memo=memo)
+        eval_results = (material_results, question_results, answer_results)
+        if cache is not None:
+            cache.put(eval_key, eval_results)
+
+    print("SAVING VECTORS FOR {} (e: {})".format(
+        course_name, datetime.now() - c_start))
+    with metrics.span("save"):
+        if stream_batch is not None:
+            writer.close(course_index, len(tfidf_model.idfs))
+        else:
+            save_eval(eval_path(course_name), course_index, len(tfidf_model.idfs), *eval_results)
         tfidf_fp = os.path.join(
             DIR_PATH, "data", "tfidf.{}.pkl".format(course_name))
         with open(tfidf_fp, "wb") as tfidf_f:
             tfidf_model.save(tfidf_f)
+        llda_model.save(os.path.join(
+            DIR_PATH, "data", "llda.{}".format(course_name)))
+
+    if cache is not None:
+        print("cache: {} hits, {} misses".format(cache.hits, cache.misses))
+    if memo is not None:
+        print("inference memo: {} hits, {} misses".format(memo.hits, memo.misses))
+    print("{} done! (e: {})\n".format(
+        course_name, datetime.now() - c_start))
+    return len(course_dictionary), [len(x) for x in course_corpus]
+
+
+def run_courses(course_names, jobs, lda_multicore=False, cache=None, stream_batch=None, memo_mb=EVAL_MEMO_MB):
+    """run process_course for every course on a pool of jobs processes, each
+    limited to its share of the cores. Worker output goes to
+    data/log.<course>.txt; only a line per finished course is printed here.
+    """
+    start = datetime.now()
+    stats = {}
+    with job_pool(jobs) as (executor, cores):
+        futures = {}
+        for course_name in course_names:
+            log_fp = os.path.join(
+                DIR_PATH, "data", "log.{}.txt".format(course_name))
+            futures[executor.submit(
+                process_course, course_name, cores, log_fp, lda_multicore, cache, stream_batch,
+                memo_mb)] = course_name
+        print("RUNNING {} COURSES ON {} JOBS ({} cores each)".format(
+            len(course_names), jobs, cores))
+        for done, future in enumerate(as_completed(futures), 1):
+            course_name = futures[future]
+            try:
+                stats[course_name] = future.result()
+                status = "done"
+            except Exception as e:
+                status = "FAILED ({!r})".format(e)
+            print("[{}/{}] {} {} (e: {})".format(
+                done, len(course_names), course_name, status,
+                datetime.now() - start))
+    return [stats[course_name] for course_name in course_names if course_name in stats]
 
-        print("{} done! (e: {})\n".format(
-            course_name, datetime.now() - c_start))
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--course", dest="courses", action="append",
+                      help="course to process (repeatable, default: all)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of courses to process in parallel")
+    parser.add_option("--lda-multicore", dest="lda_multicore", action="store_true", default=False,
+                      help="train LDA with gensim's LdaMulticore within its core budget")
+    parser.add_option("--no-cache", dest="cache", action="store_false", default=True,
+                      help="retrain and re-evaluate even if cached")
+    parser.add_option("--cache-size", dest="cache_size", type="int", default=2048,
+                      help="size bound of data/cache in MB")
+    parser.add_option("--stream", dest="stream_batch", type="int", metavar="N",
+                      help="evaluate forum posts N at a time, appending to the eval store as it goes")
+    parser.add_option("--memo-size", dest="memo_mb", type="int", default=EVAL_MEMO_MB,
+                      help="MB of topic vectors kept for reuse by repeated forum posts (default 0: infer every post)")
+    metrics.add_options(parser)
+    (options, args) = parser.parse_args()
+    metrics.configure_options(options)
+
+    course_names = options.courses or COURSE_NAME_STUBS
+
+    cache = ArtifactCache(max_bytes=options.cache_size << 20) if options.cache else None
+    if options.jobs > 1:
+        course_stats = run_courses(course_names, options.jobs, options.lda_multicore, cache, options.stream_batch,
+                                   options.memo_mb)
+    else:
+        workers = os.cpu_count() or 1
+        course_stats = [process_course(course_name, workers, lda_multicore=options.lda_multicore, cache=cache,
+                                       stream_batch=options.stream_batch, memo_mb=options.memo_mb)
+                        for course_name in course_names]
+
+    all_corpus = []
+    all_docs = 0
+    all_tokens = 0
+    for n_tokens, doc_lengths in course_stats:
+        all_tokens += n_tokens
+        all_docs += len(doc_lengths)
+        all_corpus.extend(doc_lengths)
     print(all_docs)
     print(all_tokens)
     print(sum(all_corpus)/len(all_corpus))
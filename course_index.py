@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Course material document <-> module/lesson/item label index, shared by the
+model building, analysis and labelling scripts.
+"""
+import json
+import numpy as np
+
+
+class CourseIndex(object):
+    """Each level's label names are coded as integers in order of first
+    appearance. doc_labels is a docs x 3 array of (module, lesson, item) codes
+    for doc -> label lookups; level_docs/level_offsets hold, per level, the
+    doc ids grouped by code for label -> docs lookups.
+    """
+    LEVELS = ("modules", "lessons", "items")
+
+    def __init__(self):
+        self.names = {level: [] for level in self.LEVELS}
+        self.codes = {level: {} for level in self.LEVELS}
+        self._doc_labels = []
+        self.doc_labels = np.zeros((0, len(self.LEVELS)), dtype=np.int32)
+        self.level_docs = {}
+        self.level_offsets = {}
+
+    def add_document(self, module_name, lesson_name, item_name):
+        """append a document under module > lesson > item, returning its id"""
+        doc_codes = []
+        for level, name in zip(self.LEVELS, (module_name, lesson_name, item_name)):
+            code = self.codes[level].get(name)
+            if code is None:
+                code = self.codes[level][name] = len(self.names[level])
+                self.names[level].append(name)
+            doc_codes.append(code)
+        self._doc_labels.append(doc_codes)
+        return len(self._doc_labels) - 1
+
+    def freeze(self):
+        """build the lookup arrays once every document has been added"""
+        self.doc_labels = np.array(self._doc_labels, dtype=np.int32).reshape(-1, len(self.LEVELS))
+        for l, level in enumerate(self.LEVELS):
+            level_codes = self.doc_labels[:, l]
+            # stable, so each label's docs stay in ascending id order
+            self.level_docs[level] = np.argsort(level_codes, kind="stable").astype(np.int32)
+            self.level_offsets[level] = np.searchsorted(
+                level_codes[self.level_docs[level]], np.arange(len(self.names[level]) + 1))
+        return self
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """rebuild the index of an eval pickle's mapping, i.e.
+        {level: {label name: [doc ids]}}
+        """
+        index = cls()
+        doc_codes = {}
+        for l, level in enumerate(cls.LEVELS):
+            for code, (name, doc_ids) in enumerate(mapping[level].items()):
+                index.names[level].append(name)
+                index.codes[level][name] = code
+                for doc_id in doc_ids:
+                    doc_codes.setdefault(doc_id, [0] * len(cls.LEVELS))[l] = code
+        index._doc_labels = [doc_codes[doc_id] for doc_id in sorted(doc_codes)]
+        return index.freeze()
+
+    def save(self, path):
+        """write the label names and document codes as JSON"""
+        with open(path, "w") as f:
+            json.dump({"names": self.names, "doc_labels": self.doc_labels.tolist()}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            stored = json.load(f)
+        index = cls()
+        for level in cls.LEVELS:
+            index.names[level] = stored["names"][level]
+            index.codes[level] = {name: code for code, name in enumerate(index.names[level])}
+        index._doc_labels = stored["doc_labels"]
+        return index.freeze()
+
+    def __len__(self):
+        return len(self.doc_labels)
+
+    def labels(self, doc_id):
+        """[module, lesson, item] names of a document"""
+        return [self.names[level][code] for level, code in zip(self.LEVELS, self.doc_labels[doc_id])]
+
+    def docs(self, level, name):
+        """ids of the documents under a module, lesson or item name"""
+        code = self.codes[level][name]
+        offsets = self.level_offsets[level]
+        return self.level_docs[level][offsets[code]:offsets[code + 1]]
+
+    def mapping(self):
+        """{level: {label name: [doc ids]}}, as in the eval pickles"""
+        return {level: {name: self.docs(level, name).tolist() for name in self.names[level]}
+                for level in self.LEVELS}
+
+    def docid_to_labels(self):
+        """{doc id: [module, lesson, item]} for every document"""
+        return {doc_id: self.labels(doc_id) for doc_id in range(len(self))}
+
+    def label_tree(self):
+        """{module: {lesson: {item: doc id}}}, keeping the first document of
+        each item; doc ids are strings, as in the model_res JSON keys
+        """
+        label_tree = {}
+        for doc_id in range(len(self)):
+            s_module, s_lesson, s_item = self.labels(doc_id)
+            b_lesson = label_tree.setdefault(s_module, {}).setdefault(s_lesson, {})
+            b_lesson.setdefault(s_item, str(doc_id))
+        return label_tree
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""The courses of the study, shared by every pipeline script.
+"""
+COURSE_NAME_STUBS = [
+    "agile-planning-for-software-products",
+    "client-needs-and-software-requirements",
+    "design-patterns",
+    "introduction-to-software-product-management",
+    "object-oriented-design",
+    "reviews-and-metrics-for-software-improvements",
+    "service-oriented-architecture",
+    "software-architecture",
+    "software-processes-and-agile-practices",
+    "software-product-management-capstone",
+]
+
+COURSE_TITLES = {
+    "agile-planning-for-software-products": "Agile Planning for Software Products",
+    "client-needs-and-software-requirements": "Client Needs and Software Requirements",
+    "design-patterns": "Design Patterns",
+    "introduction-to-software-product-management": "Introduction to Software Product Management",
+    "object-oriented-design": "Object Oriented Design",
+    "reviews-and-metrics-for-software-improvements": "Reviews and Metrics for Software Improvements",
+    "service-oriented-architecture": "Service Oriented Architecture",
+    "software-architecture": "Software Architecture",
+    "software-processes-and-agile-practices": "Software Processes and Agile Practices",
+    "software-product-management-capstone": "Software Product Management Capstone",
+}
+
+
+def course_dump_name(course_name):
+    """directory name of a course's coursera dump under data/"""
+    return course_name.replace("-", "_")
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Columnar storage of the evaluation vectors of one course: a directory with
+one documents x topics .npy matrix per model and document set, the TF-IDF
+vectors as CSR arrays and the document ids, so readers can memory-map only
+the parts they need.
+"""
+import os
+import json
+import shutil
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from course_index import CourseIndex
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+MODELS = ("lda", "hdp", "atm", "llda")
+SETS = ("material", "questions", "answers")
+WORD_FIELDS = ("all_words", "unutilized_words")
+
+
+def eval_path(course_name):
+    return os.path.join(DIR_PATH, "data", "eval.{}".format(course_name))
+
+
+# bytes of a part file copied at a time when converting it to .npy
+COPY_BLOCK = 1 << 20
+
+
+def _dump_json(path, obj):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+class EvalWriter(object):
+    """Writes the evaluation vectors of a course to directory path in batches.
+    Each append goes to raw part files, with the committed sizes recorded in
+    progress.json; finish_set converts a set's parts to .npy files and close
+    writes the course index and meta.json. A writer opened on a directory left
+    by an interrupted writer with the same key resumes after its last append;
+    otherwise (or with key None) the directory starts over.
+    """
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self.progress_fp = os.path.join(path, "progress.json")
+        os.makedirs(path, exist_ok=True)
+        state = None
+        if key is not None and os.path.isfile(self.progress_fp):
+            with open(self.progress_fp, "r") as pf:
+                state = json.load(pf)
+            if state["key"] != key:
+                state = None
+        if state is None:
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            state = {"key": key, "sets": {}}
+        else:
+            # drop whatever was written after the last recorded append: the
+            # parts of a set whose first append was not recorded, and the tail
+            # of the recorded parts (converted parts are no longer in sizes)
+            for name in os.listdir(path):
+                if (name.endswith(".part") or name.endswith(".words.jsonl")) \
+                        and name.split(".", 1)[0] not in state["sets"]:
+                    os.remove(os.path.join(path, name))
+            for set_state in state["sets"].values():
+                for name, size in set_state["sizes"].items():
+                    with open(os.path.join(path, name), "r+b") as f:
+                        f.truncate(size)
+            if os.path.exists(os.path.join(path, "meta.json")):
+                os.remove(os.path.join(path, "meta.json"))
+        self.state = state
+        self._save_progress()
+
+    def _save_progress(self):
+        _dump_json(self.progress_fp, self.state)
+
+    def _part(self, set_name, name):
+        return "{}.{}.part".format(set_name, name)
+
+    def count(self, set_name):
+        """rows of set_name written so far"""
+        set_state = self.state["sets"].get(set_name)
+        return set_state["count"] if set_state else 0
+
+    def finished(self, set_name):
+        set_state = self.state["sets"].get(set_name)
+        return bool(set_state and set_state["finished"])
+
+    def _new_set(self, set_name, tfidf, words):
+        set_state = self.state["sets"][set_name] = {
+            "count": 0, "nnz": 0, "sizes": {}, "finished": False, "models": {},
+            "tfidf": tfidf, "words": words}
+        return set_state
+
+    def _append_bytes(self, set_state, name, data):
+        with open(os.path.join(self.path, name), "ab") as f:
+            f.write(data)
+            set_state["sizes"][name] = f.tell()
+
+    def append(self, set_name, results):
+        """append {doc id: result dict}, in the layout the eval_* functions
+        return, to set_name
+        """
+        if not results:
+            return
+        first = next(iter(results.values()))
+        set_state = self.state["sets"].get(set_name)
+        if set_state is None:
+            set_state = self._new_set(set_name, "tfidf" in first, "all_words" in first)
+            if set_state["tfidf"]:
+                self._append_bytes(set_state, self._part(set_name, "tfidf.indptr"),
+                                   np.zeros(1, dtype=np.int64).tobytes())
+        ids = list(results)
+        self._append_bytes(set_state, self._part(set_name, "ids"),
+                           "".join(json.dumps(doc_id) + "\n" for doc_id in ids).encode("utf-8"))
+        for model in MODELS:
+            # gensim gammas come as 1 x K (lda) or authors x K (atm): store flattened
+            rows = np.vstack([np.ravel(results[doc_id][model]) for doc_id in ids])
+            model_state = set_state["models"].setdefault(
+                model, {"dim": rows.shape[1], "dtype": rows.dtype.str})
+            self._append_bytes(set_state, self._part(set_name, model),
+                               rows.astype(model_state["dtype"]).tobytes())
+        if set_state["tfidf"]:
+            lengths = [len(results[doc_id]["tfidf"]) for doc_id in ids]
+            pairs = [pair for doc_id in ids for pair in results[doc_id]["tfidf"]]
+            indptr = set_state["nnz"] + np.cumsum(lengths, dtype=np.int64)
+            self._append_bytes(set_state, self._part(set_name, "tfidf.indptr"), indptr.tobytes())
+            self._append_bytes(set_state, self._part(set_name, "tfidf.indices"),
+                               np.array([idx for idx, _ in pairs], dtype=np.int32).tobytes())
+            self._append_bytes(set_state, self._part(set_name, "tfidf.data"),
+                               np.array([val for _, val in pairs], dtype=np.float64).tobytes())
+            set_state["nnz"] += len(pairs)
+        if set_state["words"]:
+            self._append_bytes(set_state, "{}.words.jsonl".format(set_name), "".join(
+                json.dumps([results[doc_id][field] for field in WORD_FIELDS]) + "\n"
+                for doc_id in ids).encode("utf-8"))
+        set_state["count"] += len(ids)
+        self._save_progress()
+
+    def _part_to_npy(self, set_state, name, npy_name, dtype, row_shape=()):
+        part_fp = os.path.join(self.path, name)
+        if name not in set_state["sizes"]:
+            # converted before an interruption
+            if os.path.exists(part_fp):
+                os.remove(part_fp)
+            return
+        row_bytes = int(np.prod(row_shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                  "shape": (os.path.getsize(part_fp) // row_bytes, ) + tuple(row_shape)}
+        # a .npy file is a header and the raw C-order data, i.e. the part file
+        with open(part_fp, "rb") as part, open(os.path.join(self.path, npy_name + ".npy"), "wb") as out:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(part, out, COPY_BLOCK)
+        self._converted(set_state, name)
+
+    def _converted(self, set_state, name):
+        # recorded before the part is removed, so a resumed writer skips it
+        del set_state["sizes"][name]
+        self._save_progress()
+        os.remove(os.path.join(self.path, name))
+
+    def finish_set(self, set_name):
+        """convert the parts of set_name to .npy files"""
+        set_state = self.state["sets"].get(set_name) or self._new_set(set_name, False, False)
+        if set_state["finished"]:
+            return
+        ids_part = self._part(set_name, "ids")
+        ids_npy = os.path.join(self.path, "{}.ids.npy".format(set_name))
+        if ids_part in set_state["sizes"]:
+            # ids are small next to the vectors: material item numbers or post ids
+            with open(os.path.join(self.path, ids_part), "r") as f:
+                ids = [json.loads(line) for line in f]
+            np.save(ids_npy, np.array(ids))
+            self._converted(set_state, ids_part)
+        elif not os.path.exists(ids_npy):
+            np.save(ids_npy, np.array([]))
+        for model in MODELS:
+            model_state = set_state["models"].get(model)
+            if model_state is None:
+                np.save(os.path.join(self.path, "{}.{}.npy".format(set_name, model)), np.zeros((0, 0)))
+                continue
+            self._part_to_npy(set_state, self._part(set_name, model), "{}.{}".format(set_name, model),
+                              np.dtype(model_state["dtype"]), (model_state["dim"], ))
+        if set_state["tfidf"]:
+            for name, dtype in (("indptr", np.int64), ("indices", np.int32), ("data", np.float64)):
+                part = "tfidf.{}".format(name)
+                self._part_to_npy(set_state, self._part(set_name, part), "{}.{}".format(set_name, part), dtype)
+        set_state["sizes"] = {}
+        set_state["finished"] = True
+        self._save_progress()
+
+    def close(self, course_index, idf_vec_size):
+        """finish every set and write the course index and meta.json"""
+        for set_name in SETS:
+            self.finish_set(set_name)
+        course_index.save(os.path.join(self.path, "course_index.json"))
+        meta = {"idf_vec_size": idf_vec_size, "models": list(MODELS), "sets": {
+            set_name: {field: self.state["sets"][set_name][field] for field in ("count", "tfidf", "words")}
+            for set_name in SETS}}
+        _dump_json(os.path.join(self.path, "meta.json"), meta)
+        os.remove(self.progress_fp)
+
+
+def save_eval(path, course_index, idf_vec_size, material_results, question_results, answer_results):
+    """write the eval_* result dicts of a course to directory path"""
+    writer = EvalWriter(path)
+    for set_name, results in zip(SETS, (material_results, question_results, answer_results)):
+        writer.append(set_name, results)
+    writer.close(course_index, idf_vec_size)
+
+
+class EvalStore(object):
+    """Reader of a directory written by save_eval. Arrays are memory-mapped
+    unless mmap is False, and only loaded when asked for.
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap_mode = "r" if mmap else None
+        with open(os.path.join(path, "meta.json"), "r") as mf:
+            self.meta = json.load(mf)
+        self.idf_vec_size = self.meta["idf_vec_size"]
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode=self.mmap_mode)
+
+    def count(self, set_name):
+        return self.meta["sets"][set_name]["count"]
+
+    def ids(self, set_name):
+        return self._load("{}.ids".format(set_name))
+
+    def matrix(self, set_name, model):
+        """documents x topics matrix of one model"""
+        return self._load("{}.{}".format(set_name, model))
+
+    def tfidf(self, set_name):
+        """documents x vocabulary CSR matrix of the TF-IDF vectors"""
+        arrays = [self._load("{}.tfidf.{}".format(set_name, name)) for name in ("data", "indices", "indptr")]
+        return csr_matrix(tuple(arrays), shape=(self.count(set_name), self.idf_vec_size))
+
+    def words(self, set_name):
+        """{all_words: [...], unutilized_words: [...]}, aligned with ids"""
+        words = {field: [] for field in WORD_FIELDS}
+        with open(os.path.join(self.path, "{}.words.jsonl".format(set_name)), "r") as wf:
+            for line in wf:
+                for field, value in zip(WORD_FIELDS, json.loads(line)):
+                    words[field].append(value)
+        return words
+
+    def course_index(self):
+        return CourseIndex.load(os.path.join(self.path, "course_index.json"))
+
+    def results(self, set_name, models=MODELS):
+        """{doc id: result dict} in the layout the eval_* functions return,
+        with rows of the memory-mapped matrices as vectors
+        """
+        set_meta = self.meta["sets"][set_name]
+        ids = self.ids(set_name).tolist()
+        matrices = {model: self.matrix(set_name, model) for model in models}
+        if set_meta["tfidf"]:
+            tfidf = self.tfidf(set_name)
+        if set_meta["words"]:
+            words = self.words(set_name)
+        results = {}
+        for row, doc_id in enumerate(ids):
+            result = {model: matrix[row] for model, matrix in matrices.items()}
+            if set_meta["tfidf"]:
+                a, b = tfidf.indptr[row], tfidf.indptr[row + 1]
+                result["tfidf"] = list(zip(tfidf.indices[a:b].tolist(), tfidf.data[a:b].tolist()))
+            if set_meta["words"]:
+                for field in WORD_FIELDS:
+                    result[field] = words[field][row]
+            results[doc_id] = result
+        return results
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Memo of the topic vectors inferred for forum posts, so repeated posts
+("+1", "thanks", reposted or quoted questions) are inferred once per course.
+"""
+import json
+import hashlib
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+
+def _nbytes(vectors):
+    return sum(np.asarray(vector).nbytes for vector in vectors.values())
+
+
+class InferenceMemo(object):
+    """Vectors of each model keyed on a post's bag of words, least recently
+    used entries evicted beyond max_bytes. The memo is only valid for the
+    models it was filled from. Reuse is repeatable but not transparent: lda
+    and llda draw random numbers and the author topic model updates its gamma
+    state per inferred post, so skipping a repeat changes their vectors of
+    the posts after it (hdp, tfidf and the word lists stay the same).
+    """
+
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(words, vocabulary):
+        """digest of the counts of the post's words in vocabulary, which is
+        all of the post the models see
+        """
+        counts = Counter(word for word in words if word in vocabulary)
+        blob = json.dumps(sorted(counts.items()))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def lookup(self, keys):
+        """({key: vectors} of the memoized keys, [the other keys, once each]).
+        A key repeated in keys counts as a hit after its first occurrence.
+        """
+        found, missing, pending = {}, [], set()
+        for key in keys:
+            if key in found or key in pending:
+                self.hits += 1
+            elif key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+                self.hits += 1
+            else:
+                missing.append(key)
+                pending.add(key)
+                self.misses += 1
+        return found, missing
+
+    def put(self, key, vectors):
+        size = _nbytes(vectors)
+        if key in self.entries or size > self.max_bytes:
+            return
+        self.entries[key] = vectors
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
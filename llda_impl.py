@@ -10,38 +10,459 @@
 # which was modified from https://github.com/shuyo/iir/blob/master/lda/llda.py
 
 
+import os
 import sys
 import re
+import json
+import ctypes
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from optparse import OptionParser
 
 import numpy
+import scipy.sparse
 
 
-def load_corpus(filename):
-    corpus = []
-    labels = []
-    labelmap = dict()
+LABEL_PATTERN = re.compile(r'\[(.+?)\](.+)')
+TERM_PATTERN = re.compile(r'\w+(?:\'\w+)?')
+
+
+def iter_corpus(filename):
+    """lazily yield (labels, terms) for every non-empty line of a corpus file,
+    labels being None for lines without a leading [label,...] block
+    """
     with open(filename, 'r') as f:
         for line in f:
-            mt = re.match(r'\[(.+?)\](.+)', line)
+            mt = LABEL_PATTERN.match(line)
             if mt:
                 label = mt.group(1).split(',')
-                for x in label: labelmap[x] = 1 
                 line = mt.group(2)
             else:
                 label = None
-            doc = re.findall(r'\w+(?:\'\w+)?',line.lower())
+            doc = TERM_PATTERN.findall(line.lower())
             if len(doc) > 0:
-                corpus.append(doc)
-                labels.append(label)
+                yield label, doc
+
+
+def load_corpus(filename):
+    corpus = []
+    labels = []
+    labelmap = dict()
+    for label, doc in iter_corpus(filename):
+        if label:
+            for x in label: labelmap[x] = 1
+        corpus.append(doc)
+        labels.append(label)
     return labelmap.keys(), corpus, labels
 
 
+def _iter_docs(tokens, z_flat, offsets, n_m_z, label_indices, label_offsets, K, masks=True):
+    """yield (doc, z_n, ids, label, n_m) per document of a CSR corpus, with the
+    document's label counts scattered into a dense length-K vector. Assignments
+    and counts are written back once the caller moves on to the next document.
+    """
+    offsets = offsets.tolist()
+    label_offsets = label_offsets.tolist()
+    for m in range(len(offsets) - 1):
+        a, b = offsets[m], offsets[m + 1]
+        lo, hi = label_offsets[m], label_offsets[m + 1]
+        ids = label_indices[lo:hi]
+        label = None
+        if masks:
+            label = numpy.zeros(K)
+            label[ids] = 1.0
+        n_m = numpy.zeros(K, dtype=numpy.int32)
+        n_m[ids] = n_m_z[lo:hi]
+        z_n = z_flat[a:b].tolist()
+        yield tokens[a:b].tolist(), z_n, ids, label, n_m
+        z_flat[a:b] = z_n
+        n_m_z[lo:hi] = n_m[ids]
+
+
+def _dense_sweep(docs, n_z_t, n_z, alpha, beta, vbeta, rng):
+    """one gibbs sweep sampling each token over all K labels"""
+    for doc, z_n, ids, label, n_m in docs:
+        for n in range(len(doc)):
+            t = doc[n]
+            z = z_n[n]
+            n_m[z] -= 1
+            n_z_t[z, t] -= 1
+            n_z[z] -= 1
+
+            denom_b = n_z + vbeta
+
+            p_z = label * (n_z_t[:, t] + beta) * (n_m + alpha) / denom_b
+            new_z = rng.multinomial(1, p_z / p_z.sum()).argmax()
+
+            z_n[n] = new_z
+            n_m[new_z] += 1
+            n_z_t[new_z, t] += 1
+            n_z[new_z] += 1
+
+
+def _sparse_sweep(docs, n_z_t, n_z, alpha, beta, vbeta, rng):
+    """one gibbs sweep sampling each token over its document's active labels only"""
+    for doc, z_n, ids, _, n_m in docs:
+        for n in range(len(doc)):
+            t = doc[n]
+            z = z_n[n]
+            n_m[z] -= 1
+            n_z_t[z, t] -= 1
+            n_z[z] -= 1
+
+            p_z = (n_z_t[ids, t] + beta) * (n_m[ids] + alpha) / (n_z[ids] + vbeta)
+            cdf = numpy.cumsum(p_z)
+            new_z = ids[numpy.searchsorted(cdf, rng.random() * cdf[-1], side="right")]
+
+            z_n[n] = new_z
+            n_m[new_z] += 1
+            n_z_t[new_z, t] += 1
+            n_z[new_z] += 1
+
+
+def _alias_table(weights):
+    """vose alias table (prob, alias, weights) for drawing from unnormalized weights in O(1)"""
+    K = len(weights)
+    prob = (weights * (K / weights.sum())).tolist()
+    alias = list(range(K))
+    small = [k for k in range(K) if prob[k] < 1.0]
+    large = [k for k in range(K) if prob[k] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1.0
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    for k in small + large:
+        prob[k] = 1.0
+    return prob, alias, weights.tolist()
+
+
+def _alias_draw(table, rng):
+    prob, alias, _ = table
+    k = rng.integers(len(prob))
+    if rng.random() < prob[k]:
+        return k
+    return alias[k]
+
+
+def _mh_draw(s, t, n, z_n, n_m, label, ids, n_z_t, n_z, table, alpha, beta, vbeta, mh_steps, rng,
+             base_z_t=None, base_z=None, u=None, own_weight=None):
+    """LightLDA-style cycle of doc and stale word proposals, starting from label s.
+    Counts exclude the current token. base_z_t/base_z hold frozen model counts
+    that are added to n_z_t/n_z during inference, where n_z_t is indexed by the
+    document-local word column u instead of t.
+    During training the stale table still counts the current token at s; with
+    own_weight, the weight of s without it, draws of s are thinned to that
+    weight so the word proposal does not depend on the current assignment
+    (otherwise the chain is biased towards it).
+    """
+    def word_weight(k):
+        if base_z_t is None:
+            return (n_z_t[k, t] + beta) / (n_z[k] + vbeta)
+        return (n_z_t[k, u] + base_z_t[k, t] + beta) / (n_z[k] + base_z[k] + vbeta)
+
+    N = len(z_n) - 1
+    n_ids = len(ids)
+    q_w = table[2]
+    z0 = s
+    if own_weight is not None:
+        q_w = list(q_w)
+        q_w[z0] = own_weight
+    for _ in range(mh_steps):
+        # doc proposal q(k) ~ n_m[k] + alpha over the active labels
+        if rng.random() * (N + n_ids * alpha) < N:
+            j = rng.integers(N)
+            if j >= n:
+                j += 1
+            k = z_n[j]
+        else:
+            k = ids[rng.integers(n_ids)]
+        if k != s:
+            accept = word_weight(k) / word_weight(s)
+            if accept >= 1.0 or rng.random() < accept:
+                s = k
+
+        # word proposal q(k) ~ stale (n_z_t[k, t] + beta) / (n_z[k] + vbeta)
+        k = _alias_draw(table, rng)
+        while own_weight is not None and k == z0 and rng.random() * table[2][z0] >= own_weight:
+            k = _alias_draw(table, rng)
+        if k != s and label[k]:
+            accept = (word_weight(k) * (n_m[k] + alpha) * q_w[s]) / \
+                (word_weight(s) * (n_m[s] + alpha) * q_w[k])
+            if accept >= 1.0 or rng.random() < accept:
+                s = k
+    return s
+
+
+def _mh_sweep(docs, n_z_t, n_z, alpha, beta, vbeta, mh_steps, rng):
+    """one sweep of metropolis-hastings sampling, word alias tables rebuilt once per sweep"""
+    tables = {}
+    for doc, z_n, ids, label, n_m in docs:
+        for n in range(len(doc)):
+            t = doc[n]
+            if t not in tables:
+                # built before any token of t moves this sweep, so it counts each at its current
+                # label; kept with the weights of one of them removed
+                column, norm = n_z_t[:, t] + beta, n_z + vbeta
+                with numpy.errstate(divide="ignore", invalid="ignore"):
+                    tables[t] = _alias_table(column / norm), ((column - 1) / (norm - 1)).tolist()
+            table, own_weights = tables[t]
+            z = z_n[n]
+            n_m[z] -= 1
+            n_z_t[z, t] -= 1
+            n_z[z] -= 1
+
+            new_z = _mh_draw(z, t, n, z_n, n_m, label, ids, n_z_t, n_z, table,
+                             alpha, beta, vbeta, mh_steps, rng,
+                             own_weight=own_weights[z])
+
+            z_n[n] = new_z
+            n_m[new_z] += 1
+            n_z_t[new_z, t] += 1
+            n_z[new_z] += 1
+
+
+def _sweep(tokens, z_flat, offsets, n_m_z, label_indices, label_offsets, n_z_t, n_z, rng,
+           alpha, beta, vbeta, sampler="gibbs", sparse=False, mh_steps=2):
+    docs = _iter_docs(tokens, z_flat, offsets, n_m_z, label_indices, label_offsets, len(n_z),
+                      masks=sampler == "alias" or not sparse)
+    if sampler == "alias":
+        _mh_sweep(docs, n_z_t, n_z, alpha, beta, vbeta, mh_steps, rng)
+    elif sparse:
+        _sparse_sweep(docs, n_z_t, n_z, alpha, beta, vbeta, rng)
+    else:
+        _dense_sweep(docs, n_z_t, n_z, alpha, beta, vbeta, rng)
+
+
+def _flatten(lists):
+    return numpy.fromiter((x for l in lists for x in l), dtype=numpy.int64)
+
+
+def _to_csr(docs):
+    """flat int32 array and int64 row offsets for a list of id lists"""
+    offsets = numpy.zeros(len(docs) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(doc) for doc in docs])
+    return _flatten(docs).astype(numpy.int32), offsets
+
+
+def _doc_index(offsets):
+    """row number of every entry in a CSR array"""
+    return numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+
+
+def _init_assignments(offsets, label_indices, label_offsets, rng):
+    """draw every token's label uniformly from its document's active labels"""
+    doc_index = _doc_index(offsets)
+    n_ids = numpy.diff(label_offsets)
+    r = (rng.random(len(doc_index)) * n_ids[doc_index]).astype(numpy.int64)
+    return label_indices[label_offsets[doc_index] + r].astype(numpy.int32)
+
+
+def _label_counts(offsets, z_flat, label_indices, label_offsets, K):
+    """per-document label counts aligned with label_indices"""
+    token_keys = _doc_index(offsets) * K + z_flat
+    label_keys = _doc_index(label_offsets) * K + label_indices
+    positions = numpy.searchsorted(label_keys, token_keys)
+    return numpy.bincount(positions, minlength=len(label_indices)).astype(numpy.int32)
+
+
+def _shards(offsets, workers):
+    """contiguous (start, end) document ranges holding roughly equal token counts"""
+    M = len(offsets) - 1
+    if M <= 0:
+        return []
+    bounds = numpy.searchsorted(offsets[1:], numpy.linspace(0, offsets[-1], workers + 1)[1:-1])
+    edges = [0] + sorted(set(min(int(b) + 1, M) for b in bounds)) + [M]
+    return [(start, end) for start, end in zip(edges[:-1], edges[1:]) if start < end]
+
+
+def _to_memmap(path, array):
+    """copy array into a .npy file and return it memory-mapped read/write"""
+    mapped = numpy.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+    mapped[:] = array
+    mapped.flush()
+    return mapped
+
+
+# per-process state of the AD-LDA training pool, set by _init_train_worker
+_train_state = {}
+
+
+def _init_train_worker(n_z_t_buf, n_z_buf, shape, tokens, offsets, label_indices, label_offsets, params):
+    _train_state["n_z_t"] = numpy.frombuffer(n_z_t_buf, dtype=numpy.int32).reshape(shape)
+    _train_state["n_z"] = numpy.frombuffer(n_z_buf, dtype=numpy.int32)
+    _train_state["tokens"] = tokens
+    _train_state["offsets"] = offsets
+    _train_state["label_indices"] = label_indices
+    _train_state["label_offsets"] = label_offsets
+    _train_state["params"] = params
+
+
+def _train_shard(task):
+    """sweep one shard against a private copy of the shared topic-word snapshot"""
+    start, end, z_flat, n_m_z, seed = task
+    rng = numpy.random.default_rng(seed)
+    n_z_t = _train_state["n_z_t"].copy()
+    n_z = _train_state["n_z"].copy()
+    offsets = _train_state["offsets"][start:end + 1]
+    label_offsets = _train_state["label_offsets"][start:end + 1]
+    _sweep(_train_state["tokens"][offsets[0]:offsets[-1]], z_flat, offsets - offsets[0], n_m_z,
+           _train_state["label_indices"][label_offsets[0]:label_offsets[-1]],
+           label_offsets - label_offsets[0], n_z_t, n_z, rng, **_train_state["params"])
+    return start, end, z_flat, n_m_z
+
+
+def _fold_in(doc, z_n, label, ids, n_z_t, n_z, rng, alpha, beta, vbeta, iteration,
+             sampler="gibbs", mh_steps=2, tables=None, min_iteration=1, tol=None):
+    """gibbs fold-in of one document against frozen model counts n_z_t/n_z.
+    Document counts are kept over its distinct words only. With tol set, stops
+    once the L1 change of theta between sweeps is at most tol (after at least
+    min_iteration sweeps). Returns the document's label counts and the number
+    of sweeps run.
+    """
+    K = len(n_z)
+    uniq, doc_u = numpy.unique(numpy.asarray(doc, dtype=numpy.int64), return_inverse=True)
+    doc_u = doc_u.tolist()
+    n_m = numpy.zeros(K, dtype=numpy.int32)
+    d_z_t = numpy.zeros((K, len(uniq)), dtype=numpy.int32)
+    d_z = numpy.zeros(K, dtype=numpy.int32)
+    for u, z in zip(doc_u, z_n):
+        n_m[z] += 1
+        d_z_t[z, u] += 1
+        d_z[z] += 1
+
+    norm = len(doc) + alpha * len(ids)
+    sweeps = 0
+    while sweeps < iteration:
+        prev_n_m = n_m.copy()
+        for n in range(len(doc)):
+            t = doc[n]
+            u = doc_u[n]
+            z = z_n[n]
+            n_m[z] -= 1
+            d_z_t[z, u] -= 1
+            d_z[z] -= 1
+
+            if sampler == "alias":
+                if t not in tables:
+                    tables[t] = _alias_table((n_z_t[:, t] + beta) / (n_z + vbeta))
+                new_z = _mh_draw(z, t, n, z_n, n_m, label, ids, d_z_t, d_z, tables[t],
+                                 alpha, beta, vbeta, mh_steps, rng, n_z_t, n_z, u)
+            else:
+                p_z = label * (d_z_t[:, u] + n_z_t[:, t] + beta) * (n_m + alpha) / (d_z + n_z + vbeta)
+                new_z = rng.multinomial(1, p_z / p_z.sum()).argmax()
+
+            z_n[n] = new_z
+            n_m[new_z] += 1
+            d_z_t[new_z, u] += 1
+            d_z[new_z] += 1
+        sweeps += 1
+        if tol is not None and sweeps >= min_iteration and \
+                numpy.abs(n_m - prev_n_m).sum() <= tol * norm:
+            break
+    return n_m, sweeps
+
+
+def _warm_assignments(tokens, offsets, label_indices, label_offsets, n_z_t, n_z, beta, vbeta):
+    """initial assignments putting each token on its most probable active
+    label under phi
+    """
+    z = numpy.empty(len(tokens), dtype=numpy.int32)
+    for m in range(len(offsets) - 1):
+        a, b = offsets[m], offsets[m + 1]
+        ids = label_indices[label_offsets[m]:label_offsets[m + 1]]
+        phi_ids = (n_z_t[:, tokens[a:b]][ids] + beta) / (n_z[ids] + vbeta)[:, numpy.newaxis]
+        z[a:b] = ids[phi_ids.argmax(axis=0)]
+    return z
+
+
+def _fold_in_csr(tokens, z_flat, offsets, label_indices, label_offsets, n_z_t, n_z, rng, tables, params):
+    """fold in every document of a CSR corpus, returning dense document-label
+    counts and the number of sweeps spent on each document
+    """
+    n_m_z = numpy.zeros((len(offsets) - 1, len(n_z)), dtype=numpy.int32)
+    sweeps = numpy.zeros(len(offsets) - 1, dtype=numpy.int32)
+    doc_label_counts = numpy.zeros(label_offsets[-1], dtype=numpy.int32)
+    docs = _iter_docs(tokens, z_flat, offsets, doc_label_counts, label_indices, label_offsets, len(n_z))
+    for m, (doc, z_n, ids, label, _) in enumerate(docs):
+        n_m_z[m], sweeps[m] = _fold_in(doc, z_n, label, ids, n_z_t, n_z, rng, tables=tables, **params)
+    return n_m_z, sweeps
+
+
+# per-process state of the inference pool, set by _init_inference_worker
+_inference_state = {}
+
+
+def _init_inference_worker(n_z_t, n_z, params, path=None):
+    if path is not None:
+        # share the saved model's pages instead of a pickled copy per worker
+        n_z_t = numpy.load(os.path.join(path, "n_z_t.npy"), mmap_mode="r")
+        n_z = numpy.load(os.path.join(path, "n_z.npy"), mmap_mode="r")
+    _inference_state["n_z_t"] = n_z_t
+    _inference_state["n_z"] = n_z
+    _inference_state["params"] = params
+    _inference_state["tables"] = {}
+
+
+def _inference_shard(task):
+    start, end, tokens, z_flat, offsets, label_indices, label_offsets, seed = task
+    n_m_z, sweeps = _fold_in_csr(tokens, z_flat, offsets, label_indices, label_offsets,
+                                 _inference_state["n_z_t"], _inference_state["n_z"], numpy.random.default_rng(seed),
+                                 _inference_state["tables"], _inference_state["params"])
+    return start, end, n_m_z, sweeps
+
+
+def _log_likelihood(phi, thetas, tokens, offsets, block=65536):
+    """sum of log p(w) = sum_k phi[k, w] theta[m, k] over a flattened token
+    array, visiting only the non-zero thetas of each token's document, in
+    blocks to bound memory
+    """
+    thetas = scipy.sparse.csr_matrix(thetas)
+    doc_index = _doc_index(offsets)
+    log_lik = 0.0
+    for start in range(0, len(tokens), block):
+        w = tokens[start:start + block]
+        m = doc_index[start:start + block]
+        row_start = thetas.indptr[m]
+        row_len = thetas.indptr[m + 1] - row_start
+        # one (token, non-zero theta) pair per active label of the token's document
+        pair = numpy.repeat(numpy.arange(len(w)), row_len)
+        pair_start = numpy.repeat(numpy.cumsum(row_len) - row_len, row_len)
+        pos = numpy.repeat(row_start, row_len) + numpy.arange(len(pair)) - pair_start
+        p_w = numpy.bincount(pair, weights=thetas.data[pos] * phi[thetas.indices[pos], w[pair]],
+                             minlength=len(w))
+        log_lik += numpy.log(p_w).sum()
+    return log_lik
+
+
 class LLDA:
-    def __init__(self, alpha, beta, K = 100):
+    SAMPLERS = ("gibbs", "alias")
+    # arrays written by save(), one .npy file each
+    ARRAYS = ("n_z_t", "n_z", "tokens", "z", "doc_offsets", "n_m_z", "label_indices", "label_offsets")
+    # tokens per block when initializing a corpus
+    BLOCK_TOKENS = 1 << 22
+
+    def __init__(self, alpha, beta, K = 100, sampler = "gibbs", mh_steps = 2, seed = None):
+        """sampler="alias" draws tokens with metropolis-hastings over alias tables
+        (LightLDA) instead of computing the full conditional per token.
+        seed (int, SeedSequence or Generator) seeds the model's own random
+        stream; worker processes are seeded from it, so seeded runs repeat exactly.
+        """
+        if sampler not in self.SAMPLERS:
+            raise ValueError("unknown sampler {}".format(sampler))
         self.alpha = alpha
         self.beta = beta
         self.K = K
+        self.sampler = sampler
+        self.mh_steps = mh_steps
+        self.rng = numpy.random.default_rng(seed)
+        self._word_tables = {}
+        self.path = None
 
     def term_to_id(self, term):
         if term not in self.vocas_id:
@@ -62,137 +483,436 @@ class LLDA:
         for x in label: vec[self.labelmap[x]] = 1.0
         return vec
 
-    def set_corpus(self, corpus, labels = []):
-
+    def label_ids(self, label):
+        """sorted active label indices of a label list, sparse form of complement_label"""
+        if not label or not getattr(self, "labelmap", None): return numpy.arange(self.K)
+        return numpy.array(sorted(set([0] + [self.labelmap[x] for x in label])))
+
+    def set_corpus(self, corpus, labels = [], mmap_dir = None):
+        """corpus is kept as flat int32 token and label-assignment arrays with
+        int64 document offsets, memory-mapped from mmap_dir if given.
+        Document labels are stored sparsely: label_indices/label_offsets hold
+        each document's active labels and n_m_z its counts over them.
+        """
         self.labelset = []
         if len(labels) != 0:
             for label in labels:
                 self.labelset += label
-            self.labelset = list(set(self.labelset))
+            self.labelset = sorted(set(self.labelset))
             self.labelset.insert(0, "common")
             self.labelmap = dict(zip(self.labelset, range(len(self.labelset))))
             self.K = len(self.labelmap)
-            self.labels = numpy.array([self.complement_label(label) for label in labels])
+            label_ids = [self.label_ids(label) for label in labels]
         else:
-            self.labels = numpy.array([[1.0 for j in range(self.K)] for i in range(len(corpus))])
-        
+            label_ids = [numpy.arange(self.K) for _ in corpus]
+        self.label_indices, self.label_offsets = _to_csr(label_ids)
+
+        self.vocas = []
+        self.vocas_id = dict()
+        tokens, offsets = _to_csr([[self.term_to_id(term) for term in doc] for doc in corpus])
+        self._set_arrays(tokens, offsets, mmap_dir)
+
+    def set_corpus_stream(self, docs, mmap_dir = None):
+        """set_corpus in a single pass over (labels, terms) pairs such as
+        iter_corpus yields. Vocabulary, label map and CSR arrays are built as
+        documents arrive, with tokens spooled to mmap_dir if given, so the
+        corpus is never held as Python lists. Documents without labels get
+        every label, as in set_corpus.
+        """
         self.vocas = []
         self.vocas_id = dict()
-        self.docs = [[self.term_to_id(term) for term in doc] for doc in corpus]
+        labelmap = {"common": 0}
+        doc_lengths = array("q")
+        label_lengths = array("q")
+        doc_label_ids = array("i")
+        if mmap_dir is None:
+            token_buf = array("i")
+        else:
+            spool_fp = os.path.join(mmap_dir, "tokens.spool")
+            spool = open(spool_fp, "wb")
+        for label, doc in docs:
+            ids = array("i", [self.term_to_id(term) for term in doc])
+            if mmap_dir is None:
+                token_buf.extend(ids)
+            else:
+                spool.write(ids.tobytes())
+            doc_lengths.append(len(ids))
+            if label:
+                ids = sorted(set([0] + [labelmap.setdefault(x, len(labelmap)) for x in label]))
+                doc_label_ids.extend(ids)
+                label_lengths.append(len(ids))
+            else:
+                label_lengths.append(-1)  # every label, expanded once K is known
 
-        M = len(corpus)
-        V = len(self.vocas)
+        if len(labelmap) > 1:
+            self.labelset = list(labelmap.keys())
+            self.labelmap = labelmap
+            self.K = len(labelmap)
+        else:
+            self.labelset = []
+        all_ids = numpy.arange(self.K, dtype=numpy.int32)
+        label_ids = []
+        pos = 0
+        for n_ids in label_lengths:
+            if n_ids < 0:
+                label_ids.append(all_ids)
+            else:
+                label_ids.append(doc_label_ids[pos:pos + n_ids])
+                pos += n_ids
+        self.label_indices, self.label_offsets = _to_csr(label_ids)
+
+        offsets = numpy.zeros(len(doc_lengths) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.frombuffer(doc_lengths, dtype=numpy.int64))
+        if mmap_dir is None:
+            tokens = numpy.frombuffer(token_buf, dtype=numpy.int32)
+        else:
+            spool.close()
+            tokens = numpy.memmap(spool_fp, dtype=numpy.int32, mode="r") if offsets[-1] else \
+                numpy.zeros(0, dtype=numpy.int32)
+        self._set_arrays(tokens, offsets, mmap_dir)
+        if mmap_dir is not None:
+            del tokens
+            os.remove(spool_fp)
+
+    def _set_arrays(self, tokens, offsets, mmap_dir = None):
+        """store the CSR corpus, draw initial assignments and build the counts,
+        a block of documents at a time so memory-mapped corpora stay on disk
+        """
+        if mmap_dir is None:
+            z = numpy.zeros(len(tokens), dtype=numpy.int32)
+        else:
+            tokens = _to_memmap(os.path.join(mmap_dir, "tokens.npy"), tokens)
+            offsets = _to_memmap(os.path.join(mmap_dir, "doc_offsets.npy"), offsets)
+            z = numpy.lib.format.open_memmap(os.path.join(mmap_dir, "z.npy"), mode="w+",
+                                             dtype=numpy.int32, shape=(len(tokens),))
+        self.tokens, self.z, self.doc_offsets = tokens, z, offsets
 
-        self.z_m_n = []
-        self.n_m_z = numpy.zeros((M, self.K), dtype=numpy.int32)
+        V = len(self.vocas)
+        self.n_m_z = numpy.zeros(len(self.label_indices), dtype=numpy.int32)
         self.n_z_t = numpy.zeros((self.K, V), dtype=numpy.int32)
-        self.n_z = numpy.zeros(self.K, dtype=numpy.int32)
-
-        for m, doc, label in zip(range(M), self.docs, self.labels):
-            N_m = len(doc)
-            z_n = [numpy.random.multinomial(1, label / label.sum()).argmax() for x in range(N_m)]
-            self.z_m_n.append(z_n)
-            for t, z in zip(doc, z_n):
-                self.n_m_z[m, z] += 1
-                self.n_z_t[z, t] += 1
-                self.n_z[z] += 1
-
-    def train(self, iteration = 100):
+        for start, end in _shards(offsets, max(1, len(tokens) // self.BLOCK_TOKENS)):
+            a, b = offsets[start], offsets[end]
+            lo, hi = self.label_offsets[start], self.label_offsets[end]
+            block_offsets = offsets[start:end + 1] - a
+            block_label_offsets = self.label_offsets[start:end + 1] - lo
+            block_z = _init_assignments(block_offsets, self.label_indices[lo:hi], block_label_offsets, self.rng)
+            z[a:b] = block_z
+            self.n_m_z[lo:hi] = _label_counts(block_offsets, block_z, self.label_indices[lo:hi],
+                                              block_label_offsets, self.K)
+            numpy.add.at(self.n_z_t, (block_z, tokens[a:b]), 1)
+        self.n_z = self.n_z_t.sum(axis=1).astype(numpy.int32)
+
+    def train(self, iteration = 100, sparse = False, workers = 1, perplexity_every = 1, doc_range = None):
+        """sparse=True samples over each document's active labels instead of all K.
+        workers > 1 runs approximate distributed (AD-LDA) sweeps over document
+        shards in a process pool, merging the count deltas after every iteration.
+        perplexity_every=N reports perplexity every N iterations (0 disables).
+        doc_range=(start, end) restricts the sweeps to those documents.
+        """
         V = len(self.vocas)
         kalpha = self.K * self.alpha
         vbeta = V * self.beta
-        
-        for _iter in range(iteration):
-            for m, doc, label in zip(range(len(self.docs)), self.docs, self.labels):
-                for n in range(len(doc)):
-                    t = doc[n]
-                    z = self.z_m_n[m][n]
-                    self.n_m_z[m, z] -= 1
-                    self.n_z_t[z, t] -= 1
-                    self.n_z[z] -= 1
-
-                    denom_b = self.n_z + vbeta
-
-                    p_z = label * (self.n_z_t[:, t] + self.beta) * (self.n_m_z[m] + self.alpha) / denom_b 
-                    new_z = numpy.random.multinomial(1, p_z / p_z.sum()).argmax()
-                    
-                    self.z_m_n[m][n] = new_z
-                    self.n_m_z[m, new_z] += 1
-                    self.n_z_t[new_z, t] += 1
-                    self.n_z[new_z] += 1
-                    
-            print("\rllda: iter {:0>3d}, perplexity {:.3f}".format(_iter, self.perplexity()), end="")
-            if _iter % 10 == 0:
+        params = dict(alpha=self.alpha, beta=self.beta, vbeta=vbeta,
+                      sampler=self.sampler, sparse=sparse, mh_steps=self.mh_steps)
+
+        first, last = doc_range or (0, len(self.doc_offsets) - 1)
+        pool = None
+        try:
+            if workers > 1:
+                pool = self._start_train_pool(workers, params)
+                shards = [(first + start, first + end) for start, end in
+                          _shards(self.doc_offsets[first:last + 1] - self.doc_offsets[first], workers)]
+
+            self._word_tables = {}
+            for _iter in range(iteration):
+                if pool is None:
+                    a, b = self.doc_offsets[first], self.doc_offsets[last]
+                    lo, hi = self.label_offsets[first], self.label_offsets[last]
+                    _sweep(self.tokens[a:b], self.z[a:b], self.doc_offsets[first:last + 1] - a,
+                           self.n_m_z[lo:hi], self.label_indices[lo:hi],
+                           self.label_offsets[first:last + 1] - lo, self.n_z_t, self.n_z, self.rng, **params)
+                else:
+                    tasks = [(start, end, self.z[self.doc_offsets[start]:self.doc_offsets[end]],
+                              self.n_m_z[self.label_offsets[start]:self.label_offsets[end]],
+                              self.rng.integers(2 ** 32))
+                             for start, end in shards]
+                    for start, end, z_flat, n_m_z in pool.map(_train_shard, tasks):
+                        self._merge_shard(start, end, z_flat, n_m_z)
+
+                if perplexity_every and (_iter % perplexity_every == 0 or _iter == iteration - 1):
+                    print("\rllda: iter {:0>3d}, perplexity {:.3f}".format(_iter, self.perplexity()), end="")
+                    if _iter % 10 == 0:
+                        print()
+            if perplexity_every:
                 print()
-        print()
-
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if workers > 1:
+                # out of the shared buffers, also when a sweep failed
+                self.n_z_t = numpy.array(self.n_z_t)
+                self.n_z = numpy.array(self.n_z)
+
+    def add_documents(self, corpus, labels = None):
+        """append documents to a trained (or loaded) model, growing the
+        vocabulary, label set and count arrays. Only the new documents get
+        initial assignments; the existing ones keep theirs and their label
+        sets. Documents whose labels are None or empty get every label, as in
+        set_corpus_stream. Returns the (start, end) document range of the new
+        documents.
+        """
+        if labels is None: labels = [[] for _ in corpus]
+        if self.labelset:
+            for label in labels:
+                for x in label or []:
+                    if x not in self.labelmap:
+                        self.labelmap[x] = len(self.labelset)
+                        self.labelset.append(x)
+        else:
+            labels = [[] for _ in corpus]
+        K_old, V_old = self.n_z_t.shape
+        self.K = max(self.K, len(self.labelset))
+
+        self.vocas = list(self.vocas)
+        tokens, offsets = _to_csr([[self.term_to_id(term) for term in doc] for doc in corpus])
+        label_indices, label_offsets = _to_csr([self.label_ids(label) for label in labels])
+        z = _init_assignments(offsets, label_indices, label_offsets, self.rng)
+
+        n_z_t = numpy.zeros((self.K, len(self.vocas)), dtype=numpy.int32)
+        n_z_t[:K_old, :V_old] = self.n_z_t
+        numpy.add.at(n_z_t, (z, tokens), 1)
+        start = len(self.doc_offsets) - 1
+        self.n_z_t = n_z_t
+        self.n_z = n_z_t.sum(axis=1).astype(numpy.int32)
+        self.n_m_z = numpy.concatenate((self.n_m_z, _label_counts(
+            offsets, z, label_indices, label_offsets, self.K)))
+        self.tokens = numpy.concatenate((self.tokens, tokens))
+        self.z = numpy.concatenate((self.z, z))
+        self.doc_offsets = numpy.concatenate((self.doc_offsets, self.doc_offsets[-1] + offsets[1:]))
+        self.label_indices = numpy.concatenate((self.label_indices, label_indices))
+        self.label_offsets = numpy.concatenate((self.label_offsets, self.label_offsets[-1] + label_offsets[1:]))
+        # in-memory now, no longer backed by the saved files
+        self.path = None
+        return start, len(self.doc_offsets) - 1
+
+    def update(self, corpus, labels = None, iteration = 20, refresh = 0, **kwargs):
+        """resume training with new documents: add them, sweep only the new
+        documents for iteration sweeps, then run refresh sweeps over the whole
+        corpus. kwargs are passed on to train.
+        """
+        doc_range = self.add_documents(corpus, labels)
+        self.train(iteration, doc_range=doc_range, **kwargs)
+        if refresh:
+            self.train(refresh, **kwargs)
+        return doc_range
+
+    def _start_train_pool(self, workers, params):
+        """move n_z_t/n_z into shared memory so every worker reads the same snapshot"""
+        n_z_t_buf = multiprocessing.RawArray(ctypes.c_int32, self.n_z_t.size)
+        n_z_buf = multiprocessing.RawArray(ctypes.c_int32, self.n_z.size)
+        n_z_t = numpy.frombuffer(n_z_t_buf, dtype=numpy.int32).reshape(self.n_z_t.shape)
+        n_z = numpy.frombuffer(n_z_buf, dtype=numpy.int32)
+        n_z_t[:] = self.n_z_t
+        n_z[:] = self.n_z
+        self.n_z_t = n_z_t
+        self.n_z = n_z
+        return multiprocessing.Pool(
+            workers, initializer=_init_train_worker,
+            initargs=(n_z_t_buf, n_z_buf, n_z_t.shape, self.tokens, self.doc_offsets,
+                      self.label_indices, self.label_offsets, params))
+
+    def _merge_shard(self, start, end, new_z, n_m_z):
+        a, b = self.doc_offsets[start], self.doc_offsets[end]
+        tokens = self.tokens[a:b]
+        old_z = self.z[a:b]
+        numpy.add.at(self.n_z_t, (old_z, tokens), -1)
+        numpy.add.at(self.n_z_t, (new_z, tokens), 1)
+        self.n_z += (numpy.bincount(new_z, minlength=self.K) - numpy.bincount(old_z, minlength=self.K)).astype(numpy.int32)
+        self.z[a:b] = new_z
+        self.n_m_z[self.label_offsets[start]:self.label_offsets[end]] = n_m_z
+
+    def inference(self, new_doc = [], label = [], iteration = 50, **kwargs):
+        result = self.inference_many([new_doc], [label], iteration=iteration, **kwargs)
+        if kwargs.get("return_iterations"):
+            return result[0][0], result[1][0]
+        return result[0]
+
+    def inference_many(self, new_docs, labels = None, iteration = 50, workers = 1,
+                       min_iteration = 1, tol = None, warm_start = False, return_iterations = False):
+        """fold in a list of documents, returning a len(new_docs) x K theta matrix.
+        workers > 1 spreads the documents over a process pool.
+        iteration is the maximum number of sweeps per document; with tol set a
+        document stops early once the L1 change of its theta between sweeps is
+        at most tol, after at least min_iteration sweeps. warm_start starts each
+        token on its most probable active label under phi instead of a uniform
+        draw. return_iterations also returns the sweeps run per document.
+        """
+        if labels is None: labels = [[] for _ in new_docs]
+        label_indices, label_offsets = _to_csr([self.label_ids(label) for label in labels])
+        tokens, offsets = self._encode(new_docs)
 
-    def inference(self, new_doc = [], label = [], iteration = 50):
         V = len(self.vocas)
-        kalpha = self.K * self.alpha
-        vbeta = V * self.beta
+        if warm_start:
+            z = _warm_assignments(tokens, offsets, label_indices, label_offsets,
+                                  self.n_z_t, self.n_z, self.beta, V * self.beta)
+        else:
+            # initial assignments, uniform over each document's active labels
+            z = _init_assignments(offsets, label_indices, label_offsets, self.rng)
+
+        params = dict(alpha=self.alpha, beta=self.beta, vbeta=V * self.beta, iteration=iteration,
+                      sampler=self.sampler, mh_steps=self.mh_steps, min_iteration=min_iteration, tol=tol)
+        if workers > 1 and len(new_docs) > 1:
+            n_m_z = numpy.zeros((len(new_docs), self.K), dtype=numpy.int32)
+            sweeps = numpy.zeros(len(new_docs), dtype=numpy.int32)
+            if self.path is None:
+                initargs = (self.n_z_t, self.n_z, params)
+            else:
+                initargs = (None, None, params, self.path)
+            pool = multiprocessing.Pool(workers, initializer=_init_inference_worker, initargs=initargs)
+            try:
+                tasks = []
+                for start, end in _shards(offsets, workers * 4):
+                    a, b = offsets[start], offsets[end]
+                    lo, hi = label_offsets[start], label_offsets[end]
+                    tasks.append((start, end, tokens[a:b], z[a:b], offsets[start:end + 1] - a,
+                                  label_indices[lo:hi], label_offsets[start:end + 1] - lo,
+                                  self.rng.integers(2 ** 32)))
+                for start, end, shard_n_m_z, shard_sweeps in pool.imap_unordered(_inference_shard, tasks):
+                    n_m_z[start:end] = shard_n_m_z
+                    sweeps[start:end] = shard_sweeps
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            n_m_z, sweeps = _fold_in_csr(tokens, z, offsets, label_indices, label_offsets,
+                                         self.n_z_t, self.n_z, self.rng, self._word_tables, params)
+
+        label_mask = numpy.zeros((len(new_docs), self.K))
+        label_mask[_doc_index(label_offsets), label_indices] = 1.0
+        n_alpha = n_m_z + label_mask * self.alpha
+        theta = n_alpha / n_alpha.sum(axis=1)[:, numpy.newaxis]
+        if return_iterations:
+            return theta, sweeps
+        return theta
+
+    def save(self, path):
+        """write the model to directory path: one .npy per array plus meta.json
+        with the hyperparameters, vocabulary and label set
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            numpy.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        with open(os.path.join(path, "meta.json"), "w") as mf:
+            json.dump({
+                "alpha": self.alpha,
+                "beta": self.beta,
+                "K": self.K,
+                "sampler": self.sampler,
+                "mh_steps": self.mh_steps,
+                "vocas": self.vocas,
+                "labelset": self.labelset,
+            }, mf)
+
+    @classmethod
+    def load(cls, path, mmap=True, seed=None):
+        """load a model written by save(). With mmap=True the arrays are
+        read-only memory maps, so processes loading the same path share pages.
+        """
+        with open(os.path.join(path, "meta.json"), "r") as mf:
+            meta = json.load(mf)
+        llda = cls(meta["alpha"], meta["beta"], K=meta["K"],
+                   sampler=meta["sampler"], mh_steps=meta["mh_steps"], seed=seed)
+        for name in cls.ARRAYS:
+            setattr(llda, name, numpy.load(os.path.join(path, name + ".npy"),
+                                           mmap_mode="r" if mmap else None))
+        llda.vocas = meta["vocas"]
+        llda.vocas_id = dict(zip(llda.vocas, range(len(llda.vocas))))
+        llda.labelset = meta["labelset"]
+        if llda.labelset:
+            llda.labelmap = dict(zip(llda.labelset, range(len(llda.labelset))))
+        if mmap:
+            llda.path = path
+        return llda
+
+    def _encode(self, new_docs):
+        """CSR token arrays of raw documents, dropping out-of-vocabulary terms"""
+        return _to_csr([[self.vocas_id[term] for term in new_doc if term in self.vocas_id]
+                        for new_doc in new_docs])
 
-        if len(label) != 0: label = numpy.array(self.complement_label(label))
-        else: label = numpy.array([1.0 for i in range(self.K)])
-            
-        doc = [self.find_term_id(term) for term in new_doc if self.find_term_id(term) is not None]
-        
-        n_m_z = numpy.zeros((1, self.K), dtype=numpy.int32)
-        n_z_t = numpy.zeros((self.K, V), dtype=numpy.int32)
-        n_z = numpy.zeros(self.K, dtype=numpy.int32)
-
-        N_m = len(doc)
-        z_n = [numpy.random.multinomial(1, label / label.sum()).argmax() for x in range(N_m)]
-        for t, z in zip(doc, z_n):
-            n_m_z[0, z] += 1
-            n_z_t[z, t] += 1
-            n_z[z] += 1
-        
-        for _iter in range(iteration):
-            for n in range(len(doc)):
-                t = doc[n]
-                z = z_n[n]
-                n_m_z[0, z] -= 1
-                n_z_t[z, t] -= 1
-                n_z[z] -= 1
-                
-                denom_b = n_z + self.n_z + vbeta
-                
-                #p_z = label * (n_z + self.n_z_t[:, t] + self.beta) * (n_m_z[0] + self.alpha) / denom_b
-                p_z = label * (n_z_t[:, t] + self.n_z_t[:, t] + self.beta) * (n_m_z[0] + self.alpha) / denom_b 
-                new_z = numpy.random.multinomial(1, p_z / p_z.sum()).argmax()
-
-                z_n[n] = new_z
-                n_m_z[0, new_z] += 1
-                n_z_t[new_z, t] += 1
-                n_z[new_z] += 1
-
-        labels = numpy.array([label])
-        n_alpha = n_m_z + labels * self.alpha
-        
-        return (n_alpha / n_alpha.sum(axis=1)[:, numpy.newaxis])[0]
-        
     def phi(self):
         """topic-word distribution"""
         V = len(self.vocas)
         return (self.n_z_t + self.beta) / (self.n_z[:, numpy.newaxis] + V * self.beta)
 
-    def theta(self):
-        """document-topic distribution"""
-        n_alpha = self.n_m_z + self.labels * self.alpha
-        return n_alpha / n_alpha.sum(axis=1)[:, numpy.newaxis]
-
-    def perplexity(self, docs=None):
-        if docs == None: docs = self.docs
+    def theta(self, sparse = False):
+        """document-topic distribution, as a scipy CSR matrix if sparse=True"""
+        n_alpha = self.n_m_z + self.alpha
+        norm = numpy.add.reduceat(n_alpha, self.label_offsets[:-1]) if len(n_alpha) else n_alpha
+        n_alpha = n_alpha / numpy.repeat(norm, numpy.diff(self.label_offsets))
+        theta = scipy.sparse.csr_matrix((n_alpha, self.label_indices, self.label_offsets),
+                                        shape=(len(self.label_offsets) - 1, self.K))
+        return theta if sparse else theta.toarray()
+
+    def perplexity(self, docs=None, labels=None, iteration=50):
+        """perplexity of the training corpus, or of held-out raw documents
+        (lists of terms) which are folded in first to get their thetas
+        """
         phi = self.phi()
-        thetas = self.theta()
+        if docs is None:
+            tokens, offsets = self.tokens, self.doc_offsets
+            thetas = self.theta(sparse=True)
+        else:
+            thetas = self.inference_many(docs, labels, iteration=iteration)
+            tokens, offsets = self._encode(docs)
+        return numpy.exp(-_log_likelihood(phi, thetas, tokens, offsets) / len(tokens))
 
-        log_per = N = 0
-        for doc, theta in zip(docs, thetas):
-            for w in doc:
-                log_per -= numpy.log(numpy.inner(phi[:,w], theta))
-            N += len(doc)
-        return numpy.exp(log_per / N)
+
+def _run_chain(task):
+    corpus, labels, options, seed, burn_in, samples, thin, train_kwargs, keep_model = task
+    llda = LLDA(seed=seed, **options)
+    llda.set_corpus(corpus, labels)
+    llda.train(burn_in, perplexity_every=0, **train_kwargs)
+    n_z_t = numpy.zeros(llda.n_z_t.shape)
+    n_m_z = numpy.zeros(llda.n_m_z.shape)
+    for _ in range(samples):
+        llda.train(thin, perplexity_every=0, **train_kwargs)
+        n_z_t += llda.n_z_t
+        n_m_z += llda.n_m_z
+    return n_z_t, n_m_z, llda if keep_model else None
+
+
+def train_chains(corpus, labels, alpha, beta, chains = 4, burn_in = 50, samples = 5, thin = 10,
+                 seed = None, processes = None, **kwargs):
+    """run independent gibbs chains in a process pool, each on its own
+    SeedSequence child stream, and average their counts over the chains and
+    the post burn-in samples (one every thin sweeps). Returns the first
+    chain's model holding the averaged counts, so phi(), theta() and
+    inference() use the pooled estimate; it is meant for inference, not for
+    further training. phi() and theta() are the distributions of the averaged
+    counts, which is not the mean of the per-sample distributions where the
+    topic (or document) totals differ between samples. kwargs go to the LLDA
+    constructor (K, sampler, mh_steps) and train (sparse, workers); the chain
+    processes are not daemonic, so each chain may run its own AD-LDA workers.
+    """
+    train_kwargs = {key: kwargs.pop(key) for key in ("sparse", "workers") if key in kwargs}
+    options = dict(alpha=alpha, beta=beta, **kwargs)
+    seeds = numpy.random.SeedSequence(seed).spawn(chains)
+    tasks = [(corpus, labels, options, chain_seed, burn_in, samples, thin, train_kwargs, c == 0)
+             for c, chain_seed in enumerate(seeds)]
+    if processes == 1 or chains == 1:
+        results = [_run_chain(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(processes or chains) as executor:
+            results = list(executor.map(_run_chain, tasks))
+
+    llda = results[0][2]
+    n_samples = chains * samples
+    llda.n_z_t = sum(n_z_t for n_z_t, _, _ in results) / n_samples
+    llda.n_m_z = sum(n_m_z for _, n_m_z, _ in results) / n_samples
+    llda.n_z = llda.n_z_t.sum(axis=1)
+    llda._word_tables = {}
+    return llda
 
 
 def main():
@@ -202,15 +922,23 @@ def main():
     parser.add_option("--beta", dest="beta", type="float", help="parameter beta", default=0.001)
     parser.add_option("-k", dest="K", type="int", help="number of topics", default=20)
     parser.add_option("-i", dest="iteration", type="int", help="train iteration count", default=100)
+    parser.add_option("--mmap", dest="mmap_dir", help="directory to memory-map the corpus arrays into")
+    parser.add_option("--resume", dest="resume", help="saved model to add the corpus to and keep training")
+    parser.add_option("--refresh", dest="refresh", type="int", help="global sweeps after resuming", default=0)
+    parser.add_option("--save", dest="save", help="directory to save the trained model to")
     (options, args) = parser.parse_args()
     if not options.filename: parser.error("need corpus filename(-f)")
 
-    labelset, corpus, labels = load_corpus(options.filename)
-
-    llda = LLDA(options.K, options.alpha, options.beta)
-    llda.set_corpus(corpus, labels)
-
-    llda.train(options.iteration)
+    if options.resume:
+        llda = LLDA.load(options.resume, mmap=False)
+        labelset, corpus, labels = load_corpus(options.filename)
+        llda.update(corpus, labels, iteration=options.iteration, refresh=options.refresh)
+    else:
+        llda = LLDA(options.alpha, options.beta, K=options.K)
+        llda.set_corpus_stream(iter_corpus(options.filename), mmap_dir=options.mmap_dir)
+        llda.train(options.iteration)
+    if options.save:
+        llda.save(options.save)
 
     phi = llda.phi()
     for v, voca in enumerate(llda.vocas):
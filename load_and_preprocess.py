@@ -11,23 +11,14 @@ from sqlite3 import connect, Error
 from bs4 import BeautifulSoup
 from gensim.parsing.preprocessing import preprocess_string
 
+from courses import COURSE_NAME_STUBS, course_dump_name
+
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 DB_NAME = "dump_coursera_partial.sqlite3"
 DB_FILE = os.path.join(DIR_PATH, DB_NAME)
 DATA_PATH = os.path.join(DIR_PATH, "data")
-COURSES = [
-    "agile_planning_for_software_products",
-    "client_needs_and_software_requirements",
-    "design_patterns",
-    "introduction_to_software_product_management",
-    "object_oriented_design",
-    "reviews_and_metrics_for_software_improvements",
-    "service_oriented_architecture",
-    "software_architecture",
-    "software_processes_and_agile_practices",
-    "software_product_management_capstone"
-]
+COURSES = [course_dump_name(course_name) for course_name in COURSE_NAME_STUBS]
 CSV_KWARGS = {
     "delimiter": ",",
     "quotechar": "\"",
@@ -343,19 +334,23 @@ def parse_and_load_discussion_questions(course_data_path, conn, course_zip_name)
 
     course_questions = {}
 
-    rows = c.fetchmany()
-    while rows:
-        for row in rows:
-            question_id, question_title, question_details = row
-            course_questions[question_id] = (
-                preprocess_string(question_title) +
-                preprocess_string(question_details)
-            )
+    # also written a question per line, for the streaming evaluation
+    questions_filepath = os.path.join(
+        course_data_path, "..", "questions.{}.json".format(course_slug))
+    with open(questions_filepath + "l", "w") as questions_lines_file:
         rows = c.fetchmany()
+        while rows:
+            for row in rows:
+                question_id, question_title, question_details = row
+                course_questions[question_id] = (
+                    preprocess_string(question_title) +
+                    preprocess_string(question_details)
+                )
+                questions_lines_file.write(json.dumps(
+                    {"id": question_id, "words": course_questions[question_id]}) + "\n")
+            rows = c.fetchmany()
 
     # save the course_questions to disk
-    questions_filepath = os.path.join(
-        course_data_path, "..", "questions.{}.json".format(course_slug))
     with open(questions_filepath, "w") as questions_file:
         json.dump(course_questions, questions_file)
 
@@ -376,20 +371,36 @@ def parse_and_load_discussion_answers(course_data_path, conn, course_zip_name):
 
     course_answers = {}
 
-    rows = c.fetchmany()
-    while rows:
-        for row in rows:
-            answer_id, answer_content = row
-            course_answers[answer_id] = preprocess_string(answer_content)
+    # also written an answer per line, for the streaming evaluation
+    answers_filepath = os.path.join(
+        course_data_path, "..", "answers.{}.json".format(course_slug))
+    with open(answers_filepath + "l", "w") as answers_lines_file:
         rows = c.fetchmany()
+        while rows:
+            for row in rows:
+                answer_id, answer_content = row
+                course_answers[answer_id] = preprocess_string(answer_content)
+                answers_lines_file.write(json.dumps(
+                    {"id": answer_id, "words": course_answers[answer_id]}) + "\n")
+            rows = c.fetchmany()
 
     # save the course_answers to disk
-    answers_filepath = os.path.join(
-        course_data_path, "..", "answers.{}.json".format(course_slug))
     with open(answers_filepath, "w") as answers_file:
         json.dump(course_answers, answers_file)
 
 
+def load_course(course, conn):
+    """load one course dump (data/<course>) into the database and write its
+    vocabulary, questions and answers json
+    """
+    print(course)
+    course_data_path = os.path.join(DATA_PATH, course)
+    load_course_data(course_data_path, conn)
+    parse_and_load_course_branch_item(course_data_path, conn, course)
+    parse_and_load_discussion_questions(course_data_path, conn, course)
+    parse_and_load_discussion_answers(course_data_path, conn, course)
+
+
 def main():
     conn = None
     try:
@@ -402,12 +413,7 @@ def main():
         create_database(conn)
 
         for course in COURSES:
-            print(course)
-            course_data_path = os.path.join(DATA_PATH, course)
-            load_course_data(course_data_path, conn)
-            parse_and_load_course_branch_item(course_data_path, conn, course)
-            parse_and_load_discussion_questions(course_data_path, conn, course)
-            parse_and_load_discussion_answers(course_data_path, conn, course)
+            load_course(course, conn)
         conn.commit()
 
         sc_end = datetime.now()
@@ -3,41 +3,27 @@
 """
 import os
 import json
-import pickle
 from PyInquirer import prompt, Separator
 from sqlite3 import connect, Error
 import xml.dom.minidom
 from gensim.parsing.preprocessing import preprocess_string
 
+from courses import COURSE_NAME_STUBS
+from eval_store import EvalStore, eval_path
+
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 DB_NAME = "dump_coursera_partial.sqlite3"
 DB_FILE = os.path.join(DIR_PATH, DB_NAME)
 
-COURSE_NAME_STUBS = [
-    "agile-planning-for-software-products",
-    "client-needs-and-software-requirements",
-    "design-patterns",
-    "introduction-to-software-product-management",
-    "object-oriented-design",
-    "reviews-and-metrics-for-software-improvements",
-    "service-oriented-architecture",
-    "software-architecture",
-    "software-processes-and-agile-practices",
-    "software-product-management-capstone",
-]
-
 
 def setup_course_inquire(course_name):
     model_res_fp = os.path.join(
         DIR_PATH, "data", "model_res.{}.json".format(course_name))
-    results_fp = os.path.join(
-        DIR_PATH, "data", "eval.{}.pkl".format(course_name))
     man_label_fp = os.path.join(
         DIR_PATH, "data", "manual_label.{}.json".format(course_name))
 
-    with open(results_fp, "rb") as rf:
-        course_results = pickle.load(rf)
+    eval_store = EvalStore(eval_path(course_name))
     with open(model_res_fp, "r") as mf:
         course_model_results = json.load(mf)
     label_results = {}
@@ -52,7 +38,7 @@ def setup_course_inquire(course_name):
     try:
         conn = connect(DB_FILE)
         inquire_course(course_name, label_results,
-                       course_results, course_model_results, conn, man_label_fp)
+                       eval_store, course_model_results, conn, man_label_fp)
     except Error as e:
         print(e)
     finally:
@@ -61,16 +47,8 @@ def setup_course_inquire(course_name):
 
 
 def inquire_questions(course_name, label_results,
-                      course_results, course_model_results, conn, man_label_fp):
-    label_tree = {}
-    for doc_id, v in course_model_results.get("docid_to_labels", {}).items():
-        s_module, s_lesson, s_item = v
-        b_module = label_tree.get(s_module, {})
-        b_lesson = b_module.get(s_lesson, {})
-        b_item = b_lesson.get(s_item, doc_id)
-        b_lesson[s_item] = b_item
-        b_module[s_lesson] = b_lesson
-        label_tree[s_module] = b_module
+                      eval_store, course_model_results, conn, man_label_fp):
+    label_tree = eval_store.course_index().label_tree()
 
     sql_select_discussion_questions = (
         "SELECT discussion_question_id, discussion_question_title, "
@@ -90,7 +68,7 @@ def inquire_questions(course_name, label_results,
                 os.system("clear")
                 print("Progress: {}/{} ({}: useful)".format(
                     len(label_results.get("questions", {})),
-                    len(course_results["question_results"]),
+                    eval_store.count("questions"),
                     len([val for val in label_results.get(
                         "questions", {}).values() if int(val) >= 0])
                 ))
@@ -197,18 +175,18 @@ def inquire_questions(course_name, label_results,
 
 
 def inquire_course(course_name, label_results,
-                   course_results, course_model_results, conn, man_label_fp):
+                   eval_store, course_model_results, conn, man_label_fp):
     question_labelled = label_results.get("questions", {})
     answer_labelled = label_results.get("answers", {})
 
     print("Labelled {}/{} questions. ({} useful)".format(
         len(question_labelled),
-        len(course_results["question_results"]),
+        eval_store.count("questions"),
         len([val for val in label_results.get(
             "questions", {}).values() if int(val) >= 0])
     ))
     print("Labelled {}/{} answers.".format(len(answer_labelled),
-                                           len(course_results["answer_results"])))
+                                           eval_store.count("answers")))
     inquiry_choices = [
         "questions",
         "answers",
@@ -227,7 +205,7 @@ def inquire_course(course_name, label_results,
         exit()
     elif q_or_a == "questions":
         inquire_questions(course_name, label_results,
-                          course_results, course_model_results, conn, man_label_fp)
+                          eval_store, course_model_results, conn, man_label_fp)
     elif q_or_a == "answers":
         # inquire_answers()
         pass
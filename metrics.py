@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Timing and memory instrumentation of the pipeline stages, written as JSON
+lines. Code marks nested spans (per course, stage, model) and adds counters
+(docs, tokens, sweeps) to the innermost open span; each span's counters are
+added to its parent when it closes. Nothing is recorded until configure() is
+called. The settings are passed on through the environment, so spawned
+worker processes record into the same file.
+
+Records:
+    {"type": "span", "path": [...], "attrs": {...}, "seconds", "cpu_seconds",
+     "counters": {...}, "rss_mb", "peak_rss_mb", ["tracemalloc_peak_mb"],
+     ["profile"], "pid", "start"}
+    {"type": "sample", "path": [...], "rss_mb", "peak_rss_mb", ["tracemalloc_mb"],
+     "pid", "time"}
+
+Run as a script to sum up the spans of a metrics file.
+"""
+import os
+import sys
+import json
+import resource
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, process_time, time
+
+ENV_VAR = "PIPELINE_METRICS"
+
+_config = None
+_lock = threading.Lock()
+_local = threading.local()
+_main_stack = []
+
+
+class Span(object):
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.path = (parent.path if parent else []) + [name]
+        self.counters = defaultdict(int)
+        self.tm_peak = 0
+
+
+def _stack():
+    if threading.current_thread() is threading.main_thread():
+        return _main_stack
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def rss_mb():
+    """current resident set size, None where /proc is not available"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _write(record):
+    record["pid"] = os.getpid()
+    line = json.dumps(record, default=repr) + "\n"
+    with _lock:
+        # one write per line, so processes appending to the file do not interleave
+        with open(_config["fp"], "a") as f:
+            f.write(line)
+
+
+def _sample(interval, stop):
+    while not stop.wait(interval):
+        record = {"type": "sample", "path": [span.name for span in _main_stack], "time": time(),
+                  "rss_mb": rss_mb(), "peak_rss_mb": peak_rss_mb()}
+        if tracemalloc.is_tracing():
+            record["tracemalloc_mb"] = tracemalloc.get_traced_memory()[0] / (1 << 20)
+        _write(record)
+
+
+def configure(fp, sample_every=None, trace_memory=False, profile=(), profile_dir=None):
+    """record to the JSON lines file fp. sample_every (seconds) starts a thread
+    sampling the RSS; trace_memory records tracemalloc peaks per span (slow,
+    python 3.9+); spans named in profile run under cProfile, their stats
+    written to profile_dir (default: next to fp).
+    """
+    global _config
+    if trace_memory and not hasattr(tracemalloc, "reset_peak"):
+        # per-span peaks need the peak reset at each span boundary
+        raise ValueError("trace_memory needs tracemalloc.reset_peak (python 3.9+)")
+    shutdown()
+    _config = {
+        "fp": os.path.abspath(fp),
+        "sample_every": sample_every,
+        "trace_memory": trace_memory,
+        "profile": list(profile),
+        "profile_dir": os.path.abspath(profile_dir or os.path.dirname(os.path.abspath(fp))),
+    }
+    os.environ[ENV_VAR] = json.dumps(_config)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if sample_every:
+        stop = threading.Event()
+        thread = threading.Thread(target=_sample, args=(sample_every, stop), daemon=True)
+        thread.start()
+        _config["sampler"] = (thread, stop)
+
+
+def shutdown():
+    """stop recording (in this process only)"""
+    global _config
+    if _config is None:
+        return
+    if "sampler" in _config:
+        thread, stop = _config.pop("sampler")
+        stop.set()
+        thread.join()
+    _config = None
+
+
+def enabled():
+    return _config is not None
+
+
+def count(name, n=1):
+    """add n to counter name of the innermost open span"""
+    stack = _stack()
+    if _config is not None and stack:
+        stack[-1].counters[name] += int(n)
+
+
+@contextmanager
+def span(name, **attrs):
+    """time the block as a span named name, nested in the open span"""
+    if _config is None:
+        yield
+        return
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    current = Span(name, attrs, parent)
+    tracing = _config["trace_memory"] and tracemalloc.is_tracing()
+    if tracing:
+        # the parent keeps the peak of its own part so far
+        if parent is not None:
+            parent.tm_peak = max(parent.tm_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    profiler = None
+    if name in _config["profile"] and not any(s.name in _config["profile"] for s in stack):
+        import cProfile
+        profiler = cProfile.Profile()
+    stack.append(current)
+    start, wall_start, cpu_start = perf_counter(), time(), process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        seconds, cpu_seconds = perf_counter() - start, process_time() - cpu_start
+        stack.pop()
+        record = {
+            "type": "span",
+            "path": current.path,
+            "attrs": dict(parent_attrs(current), **attrs),
+            "start": wall_start,
+            "seconds": seconds,
+            "cpu_seconds": cpu_seconds,
+            "counters": dict(current.counters),
+            "rss_mb": rss_mb(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if tracing:
+            current.tm_peak = max(current.tm_peak, tracemalloc.get_traced_memory()[1])
+            record["tracemalloc_peak_mb"] = current.tm_peak / (1 << 20)
+            if parent is not None:
+                parent.tm_peak = max(parent.tm_peak, current.tm_peak)
+            tracemalloc.reset_peak()
+        if profiler is not None:
+            os.makedirs(_config["profile_dir"], exist_ok=True)
+            record["profile"] = os.path.join(_config["profile_dir"], "{}.{}.{}.prof".format(
+                ".".join(str(v) for v in record["attrs"].values()) or "run", name, os.getpid()))
+            profiler.dump_stats(record["profile"])
+        if parent is not None:
+            for counter, n in current.counters.items():
+                parent.counters[counter] += n
+        _write(record)
+
+
+def context():
+    """(path, attrs) of the innermost open span (None if none), for
+    remote_parent in another process
+    """
+    stack = _stack()
+    if _config is None or not stack:
+        return None
+    return list(stack[-1].path), dict(parent_attrs(stack[-1]), **stack[-1].attrs)
+
+
+@contextmanager
+def remote_parent(parent):
+    """nest the spans opened in the block under a span of another process,
+    given by its context(). The parent's record is written by that process;
+    counters of the spans in the block are not added to it.
+    """
+    if _config is None or parent is None:
+        yield
+        return
+    path, attrs = parent
+    stack = _stack()
+    placeholder = Span(path[-1], attrs, None)
+    placeholder.path = list(path)
+    stack.append(placeholder)
+    try:
+        yield
+    finally:
+        stack.remove(placeholder)
+
+
+def spanned(name, **attrs):
+    """decorator running the function in a span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_options(parser):
+    """add the metrics options to an OptionParser"""
+    parser.add_option("--metrics", dest="metrics_fp",
+                      help="append timing and memory metrics to this JSON lines file")
+    parser.add_option("--sample-every", dest="sample_every", type="float",
+                      help="with --metrics, sample the RSS every this many seconds")
+    parser.add_option("--trace-memory", dest="trace_memory", action="store_true", default=False,
+                      help="with --metrics, record tracemalloc peaks (slow, python 3.9+)")
+    parser.add_option("--profile", dest="profile", action="append", default=[],
+                      help="with --metrics, run spans of this name under cProfile (repeatable)")
+
+
+def configure_options(options):
+    if options.metrics_fp:
+        configure(options.metrics_fp, options.sample_every, options.trace_memory, options.profile)
+
+
+def parent_attrs(current):
+    """attrs of the enclosing spans, inner ones taking precedence"""
+    attrs = {}
+    ancestors = []
+    parent = current.parent
+    while parent is not None:
+        ancestors.append(parent)
+        parent = parent.parent
+    for ancestor in reversed(ancestors):
+        attrs.update(ancestor.attrs)
+    return attrs
+
+
+def summarize(fp):
+    """{(path, model): (calls, seconds, counters)} of the span records in fp"""
+    totals = {}
+    with open(fp, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["type"] != "span":
+                continue
+            key = ("/".join(record["path"]), record["attrs"].get("model", ""))
+            calls, seconds, counters = totals.get(key, (0, 0.0, defaultdict(int)))
+            for counter, n in record["counters"].items():
+                counters[counter] += n
+            totals[key] = (calls + 1, seconds + record["seconds"], counters)
+    return totals
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit("usage: {} metrics.jsonl".format(sys.argv[0]))
+    totals = summarize(sys.argv[1])
+    for (path, model), (calls, seconds, counters) in sorted(totals.items(), key=lambda x: -x[1][1]):
+        print("{:>10.3f}s {:>5}x  {}{}  {}".format(
+            seconds, calls, path, " [{}]".format(model) if model else "",
+            " ".join("{}={}".format(k, v) for k, v in sorted(counters.items()))))
+
+
+# worker processes pick up the settings of the process that started them
+if _config is None and os.environ.get(ENV_VAR):
+    _inherited = json.loads(os.environ[ENV_VAR])
+    configure(_inherited["fp"], _inherited["sample_every"], _inherited["trace_memory"],
+              _inherited["profile"], _inherited["profile_dir"])
+
+if __name__ == "__main__":
+    main()
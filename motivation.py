@@ -3,42 +3,23 @@
 """
 import os
 import json
-import pickle
 from PyInquirer import prompt, Separator
 from sqlite3 import connect, Error
 import xml.dom.minidom
 from gensim.parsing.preprocessing import preprocess_string
 
+from courses import COURSE_NAME_STUBS
+from eval_store import EvalStore, eval_path
+
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 DB_NAME = "dump_coursera_partial.sqlite3"
 DB_FILE = os.path.join(DIR_PATH, DB_NAME)
 
-COURSE_NAME_STUBS = [
-    "agile-planning-for-software-products",
-    "client-needs-and-software-requirements",
-    "design-patterns",
-    "introduction-to-software-product-management",
-    "object-oriented-design",
-    "reviews-and-metrics-for-software-improvements",
-    "service-oriented-architecture",
-    "software-architecture",
-    "software-processes-and-agile-practices",
-    "software-product-management-capstone",
-]
-
 
 def evaluate_course(course_name, label_results,
-                      course_results, course_model_results, conn, man_label_fp):
-    label_tree = {}
-    for doc_id, v in course_model_results.get("docid_to_labels", {}).items():
-        s_module, s_lesson, s_item = v
-        b_module = label_tree.get(s_module, {})
-        b_lesson = b_module.get(s_lesson, {})
-        b_item = b_lesson.get(s_item, doc_id)
-        b_lesson[s_item] = b_item
-        b_module[s_lesson] = b_lesson
-        label_tree[s_module] = b_module
+                      eval_store, course_model_results, conn, man_label_fp):
+    label_tree = eval_store.course_index().label_tree()
 
     sql_select_discussion_questions = (
         "SELECT DISTINCT discussion_question_id, discussion_question_title, "
@@ -86,13 +67,10 @@ def main():
     course_name = "agile-planning-for-software-products"
     model_res_fp = os.path.join(
         DIR_PATH, "data", "model_res.{}.json".format(course_name))
-    results_fp = os.path.join(
-        DIR_PATH, "data", "eval.{}.pkl".format(course_name))
     man_label_fp = os.path.join(
         DIR_PATH, "data", "manual_label.{}.json".format(course_name))
 
-    with open(results_fp, "rb") as rf:
-        course_results = pickle.load(rf)
+    eval_store = EvalStore(eval_path(course_name))
     with open(model_res_fp, "r") as mf:
         course_model_results = json.load(mf)
     label_results = {}
@@ -107,7 +85,7 @@ def main():
     try:
         conn = connect(DB_FILE)
         evaluate_course(course_name, label_results,
-                       course_results, course_model_results, conn, man_label_fp)
+                       eval_store, course_model_results, conn, man_label_fp)
     except Error as e:
         print(e)
     finally:
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Run the whole pipeline (preprocess, build, analyze, plot) as a graph of
+(stage, course) nodes. Every finished node is recorded in
+data/pipeline_state.json with digests of its inputs, so a rerun, including
+one after an interrupted or crashed run, only runs the nodes that failed,
+have missing outputs or whose inputs changed. Independent nodes run in
+parallel.
+"""
+import os
+import sys
+import json
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import redirect_stdout
+from datetime import datetime
+from hashlib import sha256
+from optparse import OptionParser
+
+import metrics
+from artifact_cache import ArtifactCache, file_digest
+from build_run_eval_lda_models import job_pool
+from courses import COURSE_NAME_STUBS, course_dump_name
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+DATA_PATH = os.path.join(DIR_PATH, "data")
+STATE_FP = os.path.join(DATA_PATH, "pipeline_state.json")
+
+
+def run_preprocess(course_name, cores, cache):
+    from csv import field_size_limit
+    from sqlite3 import connect
+    import load_and_preprocess
+    field_size_limit(sys.maxsize)
+    conn = connect(load_and_preprocess.DB_FILE)
+    try:
+        load_and_preprocess.create_database(conn)
+        load_and_preprocess.load_course(course_dump_name(course_name), conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_build(course_name, cores, cache):
+    from build_run_eval_lda_models import process_course
+    process_course(course_name, cores, cache=ArtifactCache() if cache else None)
+
+
+def run_analyze(course_name, cores, cache):
+    from analyze_model_results import analyze_course_results
+    from eval_store import EvalStore, eval_path
+    analyze_course_results(course_name, EvalStore(eval_path(course_name)))
+
+
+def run_plot(course_name, cores, cache):
+    # no display in a worker, figures are only rendered
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import sample_and_plot_results
+    sample_and_plot_results.main()
+
+
+def data_fps(*patterns):
+    return lambda course_name: [os.path.join(DATA_PATH, pattern.format(course_name)) for pattern in patterns]
+
+
+# inputs/outputs map a course name (None for stages over all courses) to paths;
+# exclusive stages run one node at a time (preprocess shares the sqlite file)
+Stage = namedtuple("Stage", "name run inputs outputs deps per_course exclusive")
+STAGES = [
+    Stage("preprocess", run_preprocess,
+          lambda course_name: [os.path.join(DATA_PATH, course_dump_name(course_name))],
+          data_fps("vocabulary.{}.json", "questions.{}.json", "answers.{}.json"),
+          (), True, True),
+    Stage("build", run_build,
+          data_fps("vocabulary.{}.json", "questions.{}.json", "answers.{}.json"),
+          data_fps("eval.{}", "tfidf.{}.pkl", "llda.{}"),
+          ("preprocess", ), True, False),
+    Stage("analyze", run_analyze,
+          data_fps("eval.{}"),
+          data_fps("model_res.{}.json", "forum_only_vocabulary.{}.json"),
+          ("build", ), True, False),
+    Stage("plot", run_plot,
+          lambda _: [fp for course_name in COURSE_NAME_STUBS
+                     for fp in data_fps("model_res.{}.json", "manual_label.{}.json")(course_name)],
+          lambda _: [os.path.join(DIR_PATH, "final_rr.csv")],
+          ("analyze", ), False, False),
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+def path_digest(path):
+    """content digest of a file; for a directory, a digest of its files'
+    names, sizes and modification times; None if missing
+    """
+    if os.path.isdir(path):
+        digest = sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                fp = os.path.join(root, name)
+                stat = os.stat(fp)
+                digest.update("{}\0{}\0{}\n".format(
+                    os.path.relpath(fp, path), stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+        return digest.hexdigest()
+    if os.path.isfile(path):
+        return file_digest(path)
+    return None
+
+
+def node_key(node):
+    stage_name, course_name = node
+    return stage_name if course_name is None else "{}:{}".format(stage_name, course_name)
+
+
+def load_state():
+    if not os.path.isfile(STATE_FP):
+        return {}
+    with open(STATE_FP, "r") as sf:
+        return json.load(sf)
+
+
+def save_state(state):
+    tmp_fp = STATE_FP + ".tmp"
+    with open(tmp_fp, "w") as sf:
+        json.dump(state, sf, indent=1, sort_keys=True)
+    os.replace(tmp_fp, STATE_FP)
+
+
+def digests(paths):
+    return {os.path.relpath(path, DIR_PATH): path_digest(path) for path in paths}
+
+
+def is_stale(stage, course_name, record, input_digests):
+    if not record or record.get("status") != "done":
+        return True
+    if not all(os.path.exists(path) for path in stage.outputs(course_name)):
+        return True
+    return record.get("inputs") != input_digests
+
+
+def _run_node(stage_name, course_name, log_fp, cores, cache):
+    with open(log_fp, "w") as lf, redirect_stdout(lf), metrics.span(stage_name, course=course_name):
+        STAGES_BY_NAME[stage_name].run(course_name, cores, cache)
+
+
+def build_graph(stage_names, course_names):
+    """nodes in stage order and the dependencies of each among them"""
+    nodes = []
+    for stage in STAGES:
+        if stage.name in stage_names:
+            nodes.extend((stage.name, course_name) for course_name in
+                         (course_names if stage.per_course else [None]))
+    deps = {}
+    for node in nodes:
+        stage = STAGES_BY_NAME[node[0]]
+        deps[node] = [other for other in nodes if other[0] in stage.deps and
+                      (other[1] == node[1] or not stage.per_course or other[1] is None)]
+    return nodes, deps
+
+
+def run_pipeline(stage_names, course_names, jobs=1, force=False, dry_run=False, cache=True):
+    """run the stale nodes of the selected stages and courses; dependencies on
+    stages that are not selected count as satisfied. Returns the number of
+    failed or blocked nodes.
+    """
+    nodes, deps = build_graph(stage_names, course_names)
+    state = load_state()
+    status = {}
+    running = {}
+    start = datetime.now()
+
+    def report(node, node_status, detail=""):
+        status[node] = node_status
+        print("[{}/{}] {} {}{} (e: {})".format(
+            len(status), len(nodes), node_key(node), node_status, detail, datetime.now() - start))
+
+    with job_pool(jobs) as (executor, cores):
+        try:
+            while len(status) < len(nodes):
+                progressed = False
+                scheduled = {node for node, _ in running.values()}
+                for node in nodes:
+                    if node in status or node in scheduled:
+                        continue
+                    dep_status = [status.get(dep) for dep in deps[node]]
+                    if None in dep_status:
+                        continue
+                    stage = STAGES_BY_NAME[node[0]]
+                    progressed = True
+                    if any(s in ("failed", "blocked") for s in dep_status):
+                        report(node, "blocked")
+                        continue
+                    input_digests = digests(stage.inputs(node[1]))
+                    upstream_ran = "would run" in dep_status
+                    if not force and not upstream_ran and \
+                            not is_stale(stage, node[1], state.get(node_key(node)), input_digests):
+                        report(node, "up to date")
+                        continue
+                    if dry_run:
+                        report(node, "would run")
+                        continue
+                    if stage.exclusive and any(other[0] == stage.name for other in scheduled):
+                        continue
+                    log_fp = os.path.join(DATA_PATH, "log.{}.txt".format(node_key(node).replace(":", ".")))
+                    # a node interrupted while running must not keep an earlier "done"
+                    state[node_key(node)] = {"status": "running", "started": datetime.now().isoformat()}
+                    save_state(state)
+                    future = executor.submit(_run_node, stage.name, node[1], log_fp, cores, cache)
+                    running[future] = (node, input_digests)
+                    scheduled.add(node)
+                    print("started {} (log: {})".format(node_key(node), os.path.relpath(log_fp, DIR_PATH)))
+                if not running:
+                    if not progressed:
+                        break
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, input_digests = running.pop(future)
+                    stage = STAGES_BY_NAME[node[0]]
+                    try:
+                        future.result()
+                        state[node_key(node)] = {
+                            "status": "done",
+                            "inputs": input_digests,
+                            "outputs": digests(stage.outputs(node[1])),
+                            "finished": datetime.now().isoformat(),
+                        }
+                        report(node, "done")
+                    except Exception as e:
+                        state[node_key(node)] = {"status": "failed", "error": repr(e),
+                                                 "finished": datetime.now().isoformat()}
+                        report(node, "failed", " ({!r})".format(e))
+                    # record every finished node, so an interrupted run resumes here
+                    save_state(state)
+        except KeyboardInterrupt:
+            for future in running:
+                future.cancel()
+            raise
+    return len([s for s in status.values() if s in ("failed", "blocked")])
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of nodes to run in parallel")
+    parser.add_option("-c", "--course", dest="courses", action="append",
+                      help="course to run (repeatable, default: all)")
+    parser.add_option("-s", "--stage", dest="stages", action="append",
+                      help="stage to run, one of {} (repeatable, default: all)".format(
+                          ", ".join(stage.name for stage in STAGES)))
+    parser.add_option("-f", "--force", dest="force", action="store_true", default=False,
+                      help="rerun nodes even if up to date")
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="only list the nodes that would run")
+    parser.add_option("--no-cache", dest="cache", action="store_false", default=True,
+                      help="do not reuse cached models and eval results in the build stage")
+    metrics.add_options(parser)
+    (options, args) = parser.parse_args()
+    stage_names = options.stages or [stage.name for stage in STAGES]
+    for stage_name in stage_names:
+        if stage_name not in STAGES_BY_NAME:
+            parser.error("unknown stage {}".format(stage_name))
+
+    os.makedirs(DATA_PATH, exist_ok=True)
+    metrics.configure_options(options)
+    failed = run_pipeline(stage_names, options.courses or COURSE_NAME_STUBS, options.jobs,
+                          options.force, options.dry_run, options.cache)
+    if failed:
+        print("{} nodes failed or blocked".format(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
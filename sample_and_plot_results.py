@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import os
-import pickle
 import json
 import random
 import seaborn as sns
@@ -8,20 +7,10 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import statistics
 
-DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+from analyze_model_results import model_reciprocal_ranks
+from courses import COURSE_TITLES
 
-COURSE_NAME_STUBS = {
-    "agile-planning-for-software-products": "Agile Planning for Software Products",
-    "client-needs-and-software-requirements": "Client Needs and Software Requirements",
-    "design-patterns": "Design Patterns",
-    "introduction-to-software-product-management": "Introduction to Software Product Management",
-    "object-oriented-design": "Object Oriented Design",
-    "reviews-and-metrics-for-software-improvements": "Reviews and Metrics for Software Improvements",
-    "service-oriented-architecture": "Service Oriented Architecture",
-    "software-architecture": "Software Architecture",
-    "software-processes-and-agile-practices": "Software Processes and Agile Practices",
-    "software-product-management-capstone": "Software Product Management Capstone",
-}
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
 MODEL_NAME_STUBS = {
     "atm_rank": "Author-Topic",
@@ -39,13 +28,9 @@ MODEL_NAME_STUBS = {
 def setup_course_plot(course_name_stub, course_name_readable, bootstrap=True):
     model_res_fp = os.path.join(
         DIR_PATH, "data", "model_res.{}.json".format(course_name_stub))
-    results_fp = os.path.join(
-        DIR_PATH, "data", "eval.{}.pkl".format(course_name_stub))
     man_label_fp = os.path.join(
         DIR_PATH, "data", "manual_label.{}.json".format(course_name_stub))
 
-    with open(results_fp, "rb") as rf:
-        course_results = pickle.load(rf)
     with open(model_res_fp, "r") as mf:
         course_model_results = json.load(mf)
 
@@ -75,16 +60,8 @@ def setup_course_plot(course_name_stub, course_name_readable, bootstrap=True):
     else:
         chosen_questions = base_chosen_questions
 
-    all_model_rrs = {}
-    for qid in chosen_questions:
-        correct = mmr_correct_question_labels[qid]
-        model_rank_dict = cosine_ranks[qid]
-        for model_name, model_rank in model_rank_dict.items():
-            reciprocal_ranks = all_model_rrs.get(model_name, [])
-            model_choices = [atm_choice for (atm_choice, _score) in model_rank]
-            correct_idx = model_choices.index(correct)
-            reciprocal_ranks.append(1/(correct_idx + 1))
-            all_model_rrs[model_name] = reciprocal_ranks
+    all_model_rrs = model_reciprocal_ranks(
+        cosine_ranks, mmr_correct_question_labels, chosen_questions)
 
     # convert to dataframe
     figure_label_model_name = "Model"
@@ -194,7 +171,7 @@ def main():
         "Model": [],
         "Reciprocal_Rank": []
     }
-    for course_name_stub, course_name_readable in COURSE_NAME_STUBS.items():
+    for course_name_stub, course_name_readable in COURSE_TITLES.items():
          course_pd_data_dict = setup_course_plot(course_name_stub, course_name_readable)
          for k, v_list in course_pd_data_dict.items():
             if k == "Model":
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Hyperparameter sweep of the topic models. Every configuration of a grid or
+random search space is trained per course on a process pool and scored by
+the MRR of the course material ranked for the manually labelled questions,
+alone and combined with TF-IDF (as in sample_and_plot_results.py), next to
+its training and inference time. Each course is preprocessed once: its
+token ids are written to memory mapped arrays that the workers share, and a
+worker builds its corpus from them once per course, however many
+configurations it runs. One JSON line per configuration and course is
+appended to data/sweep.jsonl.
+
+The search space is a JSON file {model: {parameter: values}} over the
+LdaModel, HdpModel and AuthorTopicModel arguments and the LLDA_PARAMS
+(alpha, beta, iterations). Values are lists; in a random search they may
+also be {"uniform": [low, high]}, {"log_uniform": [low, high]} or
+{"int": [low, high]}.
+"""
+import os
+import json
+import math
+import pickle
+import random
+import tempfile
+from collections import namedtuple
+from concurrent.futures import as_completed
+from contextlib import redirect_stdout
+from datetime import datetime
+from itertools import chain, product
+from optparse import OptionParser
+from statistics import mean
+from time import perf_counter
+
+import numpy as np
+from gensim.corpora.dictionary import Dictionary
+from gensim.models import TfidfModel
+from scipy.spatial.distance import cosine
+
+import build_run_eval_lda_models as build
+import metrics
+from analyze_model_results import model_reciprocal_ranks
+from courses import COURSE_NAME_STUBS
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+DATA_PATH = os.path.join(DIR_PATH, "data")
+RESULTS_FP = os.path.join(DATA_PATH, "sweep.jsonl")
+# the settings build_run_eval_lda_models.py uses are in each list
+DEFAULT_SPACE = {
+    "lda": {"num_topics": [50, 100, 200], "passes": [1, 5], "alpha": ["symmetric", "auto"]},
+    "hdp": {"T": [50, 150], "K": [10, 15], "kappa": [0.6, 1.0]},
+    "atm": {"num_topics": [50, 100, 200], "passes": [1, 5]},
+    "llda": {"alpha": [0.001, 0.01, 0.1], "beta": [0.0001, 0.001, 0.01], "iterations": [25, 50, 100]},
+}
+# fewest labelled questions for a course to be scored, as in the plots
+MIN_LABELS = 100
+
+# the preprocessed course a worker builds from the shared arrays
+Course = namedtuple("Course", "texts corpus dictionary index question_ids questions correct tfidf_model")
+_courses = {}
+
+
+def load_labels(course_name):
+    """{question id: doc id} of the manually labelled questions"""
+    man_label_fp = os.path.join(DATA_PATH, "manual_label.{}.json".format(course_name))
+    if not os.path.isfile(man_label_fp):
+        return {}
+    with open(man_label_fp, "r") as ml_f:
+        manually_labelled_questions = json.load(ml_f)["questions"]
+    return {q_id: int(val) for q_id, val in manually_labelled_questions.items() if int(val) >= 0}
+
+
+def _to_arrays(texts, dictionary):
+    """token ids and document offsets of texts, out of vocabulary words dropped"""
+    ids = [[dictionary.token2id[word] for word in words if word in dictionary.token2id] for words in texts]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(doc_ids) for doc_ids in ids], out=offsets[1:])
+    return np.fromiter(chain.from_iterable(ids), dtype=np.int32, count=offsets[-1]), offsets
+
+
+def _from_arrays(tokens, offsets, dictionary):
+    return [[dictionary[token_id] for token_id in tokens[offsets[d]:offsets[d + 1]]]
+            for d in range(len(offsets) - 1)]
+
+
+def snapshot_course(course_name, snapshot_dir, min_labels=MIN_LABELS):
+    """write the course's preprocessed material and labelled questions to
+    snapshot_dir, returning (docs, labelled questions), or None if the course
+    has fewer than min_labels labelled questions
+    """
+    labels = load_labels(course_name)
+    questions_fp = os.path.join(DATA_PATH, "questions.{}.json".format(course_name))
+    if len(labels) < min_labels or not os.path.isfile(questions_fp):
+        return None
+    with open(os.path.join(DATA_PATH, "vocabulary.{}.json".format(course_name)), "r") as vf:
+        course_texts, course_index = build.extract_course_texts_mapping(json.load(vf))
+    with open(questions_fp, "r") as qf:
+        course_questions = json.load(qf)
+    question_ids = [q_id for q_id in labels if q_id in course_questions]
+    if len(question_ids) < min_labels:
+        return None
+    course_dictionary = Dictionary(course_texts)
+    for kind, texts in (("material", course_texts),
+                        ("questions", [course_questions[q_id] for q_id in question_ids])):
+        tokens, offsets = _to_arrays(texts, course_dictionary)
+        np.save(os.path.join(snapshot_dir, "{}.{}.tokens.npy".format(course_name, kind)), tokens)
+        np.save(os.path.join(snapshot_dir, "{}.{}.offsets.npy".format(course_name, kind)), offsets)
+    with open(os.path.join(snapshot_dir, "{}.pkl".format(course_name)), "wb") as sf:
+        pickle.dump((course_dictionary, course_index, question_ids,
+                     [labels[q_id] for q_id in question_ids]), sf)
+    return len(course_texts), len(question_ids)
+
+
+def load_course(snapshot_dir, course_name):
+    """the Course of a snapshot, built once per process"""
+    if course_name not in _courses:
+        with open(os.path.join(snapshot_dir, "{}.pkl".format(course_name)), "rb") as sf:
+            course_dictionary, course_index, question_ids, correct = pickle.load(sf)
+        texts = {}
+        for kind in ("material", "questions"):
+            tokens = np.load(os.path.join(snapshot_dir, "{}.{}.tokens.npy".format(course_name, kind)), mmap_mode="r")
+            offsets = np.load(os.path.join(snapshot_dir, "{}.{}.offsets.npy".format(course_name, kind)))
+            texts[kind] = _from_arrays(tokens, offsets, course_dictionary)
+        course_corpus = [course_dictionary.doc2bow(text) for text in texts["material"]]
+        _courses[course_name] = Course(
+            texts["material"], course_corpus, course_dictionary, course_index, question_ids,
+            texts["questions"], correct, TfidfModel(corpus=course_corpus, id2word=course_dictionary))
+    return _courses[course_name]
+
+
+def train(model_name, course, params):
+    if model_name == "lda":
+        return build.train_lda(course.corpus, course.dictionary, params=params)
+    if model_name == "hdp":
+        return build.train_hdp(course.corpus, course.dictionary, params)
+    if model_name == "atm":
+        return build.train_atm(course.corpus, course.dictionary, course.index, params)
+    return build.train_llda(course.index, course.texts, params=params)[0]
+
+
+def infer(model_name, model, course):
+    """(material vectors, question vectors) of the model"""
+    if model_name == "llda":
+        return (model.inference_many(course.texts, **build.LLDA_FOLD_IN),
+                model.inference_many(course.questions, **build.LLDA_FOLD_IN))
+    material_chunks = build.chunked(course.corpus)
+    question_chunks = build.chunked([course.dictionary.doc2bow(words) for words in course.questions])
+    if model_name == "lda":
+        return build.infer_lda_gammas(material_chunks, model), build.infer_lda_gammas(question_chunks, model)
+    if model_name == "hdp":
+        return build.infer_hdp_gammas(material_chunks, model), build.infer_hdp_gammas(question_chunks, model)
+    # each question is a new author, as in eval_posts
+    return (build.infer_atm_gammas(material_chunks, model, model.author2doc, model.doc2author),
+            build.infer_atm_gammas(question_chunks, model,
+                                   {q_id: (idx, ) for idx, q_id in enumerate(course.question_ids)},
+                                   {idx: (q_id, ) for idx, q_id in enumerate(course.question_ids)}))
+
+
+def dense_tfidf(course, words):
+    tfidf = np.zeros(len(course.tfidf_model.idfs))
+    for tfidf_idx, val in course.tfidf_model[course.dictionary.doc2bow(words)]:
+        tfidf[tfidf_idx] = val
+    return tfidf
+
+
+def topic_maps(course, model_name, material_vectors, question_vectors):
+    """{question id: {rank name: [(doc id, cosine distance)] nearest first}}
+    of the model and the model combined with TF-IDF, or of TF-IDF alone with
+    model_name None, in the shape of analyze_model_results.generate_topic_map
+    """
+    m_tfidfs = [dense_tfidf(course, words) for words in course.texts]
+    maps = {}
+    for q_idx, q_id in enumerate(course.question_ids):
+        tfidf = dense_tfidf(course, course.questions[q_idx])
+        topic_map = {"tfidf_rank": [(doc_id, cosine(tfidf, m_tfidf)) for doc_id, m_tfidf in enumerate(m_tfidfs)]}
+        if model_name is not None:
+            vector = np.ravel(question_vectors[q_idx])
+            m_vectors = [np.ravel(m_vector) for m_vector in material_vectors]
+            topic_map = {
+                "{}_rank".format(model_name): [
+                    (doc_id, cosine(vector, m_vector)) for doc_id, m_vector in enumerate(m_vectors)],
+                "tfidf_with_{}_rank".format(model_name): [
+                    (doc_id, cosine(np.concatenate((tfidf, vector)), np.concatenate((m_tfidf, m_vector))))
+                    for doc_id, (m_tfidf, m_vector) in enumerate(zip(m_tfidfs, m_vectors))],
+            }
+        for model_rank in topic_map.values():
+            model_rank.sort(key=lambda tup: tup[1])
+        maps[q_id] = topic_map
+    return maps
+
+
+def score(course, model_name=None, material_vectors=None, question_vectors=None):
+    """{rank name: MRR over the labelled questions}"""
+    cosine_ranks = topic_maps(course, model_name, material_vectors, question_vectors)
+    all_model_rrs = model_reciprocal_ranks(
+        cosine_ranks, dict(zip(course.question_ids, course.correct)), course.question_ids)
+    return {rank_name: mean(rrs) for rank_name, rrs in all_model_rrs.items()}
+
+
+def run_config(snapshot_dir, course_name, model_name, params):
+    """train and score one configuration on a course, returning its record"""
+    course = load_course(snapshot_dir, course_name)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull), \
+            metrics.span("sweep", course=course_name, model=model_name):
+        start = perf_counter()
+        model = train(model_name, course, params)
+        train_seconds = perf_counter() - start
+        start = perf_counter()
+        material_vectors, question_vectors = infer(model_name, model, course)
+        infer_seconds = perf_counter() - start
+    mrr = score(course, model_name, material_vectors, question_vectors)
+    return {
+        "mrr": mrr["{}_rank".format(model_name)],
+        "mrr_tfidf": mrr["tfidf_with_{}_rank".format(model_name)],
+        "train_seconds": train_seconds,
+        "infer_seconds": infer_seconds,
+        "docs": len(course.texts),
+        "questions": len(course.question_ids),
+    }
+
+
+def run_baseline(snapshot_dir, course_name):
+    return score(load_course(snapshot_dir, course_name))["tfidf_rank"]
+
+
+def _draw(rnd, values):
+    if isinstance(values, list):
+        return rnd.choice(values)
+    (kind, (low, high)), = values.items()
+    if kind == "uniform":
+        return rnd.uniform(low, high)
+    if kind == "log_uniform":
+        return math.exp(rnd.uniform(math.log(low), math.log(high)))
+    if kind == "int":
+        return rnd.randint(low, high)
+    raise ValueError("unknown distribution {}".format(kind))
+
+
+def configurations(space, n_random=None, seed=0):
+    """[(model name, params)]: every point of the grid, or n_random distinct
+    random draws per model
+    """
+    configs = []
+    rnd = random.Random(seed)
+    for model_name, model_space in space.items():
+        names = sorted(model_space)
+        if n_random is None:
+            for values in model_space.values():
+                if not isinstance(values, list):
+                    raise ValueError("a grid takes lists of values, not {}".format(values))
+            configs.extend((model_name, dict(zip(names, values)))
+                           for values in product(*(model_space[name] for name in names)))
+            continue
+        seen = []
+        for _ in range(100 * n_random):
+            params = {name: _draw(rnd, model_space[name]) for name in names}
+            if params not in seen:
+                seen.append(params)
+            if len(seen) == n_random:
+                break
+        configs.extend((model_name, params) for params in seen)
+    return configs
+
+
+def seeded(model_name, params, seed):
+    """params with the random state of the model set to seed, unless given"""
+    key = "seed" if model_name == "llda" else "random_state"
+    return dict({key: seed}, **params) if seed is not None else params
+
+
+def summarize(records):
+    """per model, the configurations by mean MRR over the courses, marking
+    those no other configuration beats on both MRR and time
+    """
+    totals = {}
+    for record in records:
+        if "error" in record:
+            continue
+        key = (record["model"], json.dumps(record["params"], sort_keys=True))
+        totals.setdefault(key, []).append(record)
+    rows = []
+    for (model_name, params), config_records in totals.items():
+        rows.append((model_name, params,
+                     mean(r["mrr"] for r in config_records),
+                     mean(r["mrr_tfidf"] for r in config_records),
+                     sum(r["train_seconds"] for r in config_records),
+                     sum(r["infer_seconds"] for r in config_records)))
+    for model_name in sorted({row[0] for row in rows}):
+        model_rows = sorted((row for row in rows if row[0] == model_name), key=lambda row: -row[2])
+        print("{}:".format(model_name))
+        print("  {:>7} {:>9} {:>9} {:>9}".format("mrr", "+tfidf", "train s", "infer s"))
+        for row in model_rows:
+            cost = row[4] + row[5]
+            dominated = any(other[2] >= row[2] and other[4] + other[5] <= cost and
+                            (other[2] > row[2] or other[4] + other[5] < cost) for other in model_rows)
+            print("{} {:>7.3f} {:>9.3f} {:>9.2f} {:>9.2f}  {}".format(
+                " " if dominated else "*", row[2], row[3], row[4], row[5], row[1]))
+
+
+def run_sweep(course_names, configs, jobs=1, seed=0, min_labels=MIN_LABELS, results_fp=RESULTS_FP):
+    """run every (model name, params) of configs on every course with at
+    least min_labels labelled questions, appending a record per run to
+    results_fp as it finishes. Returns the records.
+    """
+    run = datetime.now().isoformat()
+    start = datetime.now()
+    records = []
+    os.makedirs(DATA_PATH, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=DATA_PATH, prefix="sweep.") as snapshot_dir, \
+            open(results_fp, "a") as rf:
+        swept = []
+        for course_name in course_names:
+            stats = snapshot_course(course_name, snapshot_dir, min_labels)
+            if stats is None:
+                print("{} skipped: fewer than {} labelled questions".format(course_name, min_labels))
+                continue
+            swept.append(course_name)
+            print("{}: {} docs, {} labelled questions".format(course_name, *stats))
+        with build.job_pool(jobs) as (executor, _):
+            futures = {}
+            for course_name in swept:
+                futures[executor.submit(run_baseline, snapshot_dir, course_name)] = (course_name, "tfidf", {})
+                for model_name, params in configs:
+                    futures[executor.submit(
+                        run_config, snapshot_dir, course_name, model_name,
+                        seeded(model_name, params, seed))] = (course_name, model_name, params)
+            print("SWEEPING {} CONFIGURATIONS OVER {} COURSES ON {} JOBS".format(
+                len(configs), len(swept), jobs))
+            for done, future in enumerate(as_completed(futures), 1):
+                course_name, model_name, params = futures[future]
+                record = {"run": run, "course": course_name, "model": model_name, "params": params, "seed": seed}
+                try:
+                    result = future.result()
+                    if model_name == "tfidf":
+                        record["mrr"] = result
+                    else:
+                        record.update(result)
+                    status = "mrr {:.3f}".format(record["mrr"])
+                except Exception as e:
+                    record["error"] = repr(e)
+                    status = "FAILED ({!r})".format(e)
+                rf.write(json.dumps(record) + "\n")
+                rf.flush()
+                if model_name != "tfidf":
+                    records.append(record)
+                print("[{}/{}] {} {} {} {} (e: {})".format(
+                    done, len(futures), course_name, model_name, json.dumps(params, sort_keys=True), status,
+                    datetime.now() - start))
+    return records
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--course", dest="courses", action="append",
+                      help="course to sweep (repeatable, default: all)")
+    parser.add_option("-m", "--model", dest="models", action="append",
+                      help="model to sweep, one of {} (repeatable, default: all)".format(
+                          ", ".join(build.MODEL_NAMES)))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of configurations to run in parallel")
+    parser.add_option("--space", dest="space_fp",
+                      help="JSON file of the search space (default: a small grid)")
+    parser.add_option("--random", dest="n_random", type="int", metavar="N",
+                      help="draw N configurations per model instead of searching the grid")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="seed of the random search and of the models")
+    parser.add_option("--min-labels", dest="min_labels", type="int", default=MIN_LABELS,
+                      help="skip courses with fewer labelled questions")
+    parser.add_option("-o", dest="results_fp", default=RESULTS_FP,
+                      help="results file, one JSON line per configuration and course")
+    metrics.add_options(parser)
+    (options, args) = parser.parse_args()
+
+    space = dict(DEFAULT_SPACE)
+    if options.space_fp:
+        with open(options.space_fp, "r") as sf:
+            space = json.load(sf)
+    for model_name in list(space):
+        if model_name not in build.MODEL_NAMES:
+            parser.error("unknown model {} in the search space".format(model_name))
+        if options.models and model_name not in options.models:
+            del space[model_name]
+    try:
+        configs = configurations(space, options.n_random, options.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    metrics.configure_options(options)
+    records = run_sweep(options.courses or COURSE_NAME_STUBS, configs, options.jobs, options.seed,
+                        options.min_labels, options.results_fp)
+    summarize(records)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""The alias (metropolis-hastings) sampler against the gibbs sampler of
+llda_impl.LLDA on small seeded labeled corpora. Run with pytest.
+"""
+from itertools import combinations, product
+from math import lgamma
+
+import numpy
+
+from llda_impl import LLDA
+
+ALPHA = 0.1
+BETA = 0.01
+
+
+def synthetic_corpus(seed=0, n_labels=4, n_words=120, n_docs=60, doc_length=50):
+    """documents with one or two labels, each token drawn from the word
+    distribution of one of them
+    """
+    rng = numpy.random.default_rng(seed)
+    topics = rng.dirichlet(numpy.full(n_words, 0.05), size=n_labels)
+    corpus, labels = [], []
+    for _ in range(n_docs):
+        doc_labels = rng.choice(n_labels, size=rng.integers(1, 3), replace=False)
+        mix = rng.dirichlet(numpy.ones(len(doc_labels)))
+        corpus.append(["w{}".format(rng.choice(n_words, p=topics[doc_labels[rng.choice(len(doc_labels), p=mix)]]))
+                       for _ in range(doc_length)])
+        labels.append(["l{}".format(label) for label in doc_labels])
+    return corpus, labels
+
+
+def mean_phi(corpus, labels, sampler, seed, burn_in=50, samples=10, thin=5):
+    """phi of the labels (without "common", which no document pins down)
+    averaged over the post burn-in samples of one chain
+    """
+    llda = LLDA(ALPHA, BETA, sampler=sampler, seed=seed)
+    llda.set_corpus(corpus, labels)
+    llda.train(burn_in, perplexity_every=0)
+    phi = 0
+    for _ in range(samples):
+        llda.train(thin, perplexity_every=0)
+        phi = phi + llda.phi()[1:]
+    return phi / samples
+
+
+def hellinger(phi_a, phi_b):
+    """mean hellinger distance between the rows of two phis"""
+    return numpy.mean(numpy.sqrt(0.5 * ((numpy.sqrt(phi_a) - numpy.sqrt(phi_b)) ** 2).sum(axis=1)))
+
+
+def test_alias_phi_within_gibbs_spread():
+    corpus, labels = synthetic_corpus()
+    gibbs = [mean_phi(corpus, labels, "gibbs", seed) for seed in range(3)]
+    alias = [mean_phi(corpus, labels, "alias", seed) for seed in range(3, 6)]
+    spread = max(hellinger(a, b) for a, b in combinations(gibbs, 2))
+    assert hellinger(sum(alias) / len(alias), sum(gibbs) / len(gibbs)) <= spread
+
+
+def collapsed_posterior(llda, active):
+    """{assignments: probability} of every assignment of a tiny corpus"""
+    V, K = len(llda.vocas), llda.K
+    tokens, offsets = llda.tokens.tolist(), llda.doc_offsets.tolist()
+
+    def log_p(z):
+        log_p = 0.0
+        n_z_t = numpy.zeros((K, V))
+        for m, doc_labels in enumerate(active):
+            doc_z = z[offsets[m]:offsets[m + 1]]
+            log_p += sum(lgamma(doc_z.count(k) + llda.alpha) for k in doc_labels)
+        for t, k in zip(tokens, z):
+            n_z_t[k, t] += 1
+        for k in range(K):
+            log_p += sum(lgamma(n + llda.beta) for n in n_z_t[k]) - lgamma(n_z_t[k].sum() + V * llda.beta)
+        return log_p
+
+    states = [sum(doc_z, ()) for doc_z in product(*[
+        product(doc_labels, repeat=offsets[m + 1] - offsets[m]) for m, doc_labels in enumerate(active)])]
+    p = numpy.exp([log_p(list(z)) for z in states])
+    return dict(zip(states, p / p.sum()))
+
+
+def test_samplers_match_exact_posterior(sweeps=50000):
+    corpus = [["a", "b", "a"], ["b", "a"]]
+    labels = [["x"], ["x", "y"]]
+    for sampler in LLDA.SAMPLERS:
+        llda = LLDA(0.5, 0.3, sampler=sampler, seed=1)
+        llda.set_corpus(corpus, labels)
+        exact = collapsed_posterior(llda, [llda.label_ids(label).tolist() for label in labels])
+        counts = dict.fromkeys(exact, 0)
+        for _ in range(sweeps):
+            llda.train(1, perplexity_every=0)
+            counts[tuple(llda.z.tolist())] += 1
+        total_variation = 0.5 * sum(abs(counts[z] / sweeps - p) for z, p in exact.items())
+        assert total_variation < 0.025, (sampler, total_variation)